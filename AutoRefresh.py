@@ -0,0 +1,126 @@
+# Re-run the command in an output view every so often, but only while
+# someone can see the result:
+#
+import random
+
+import sublime
+
+
+# How far each wait can stray from the interval, as a fraction of it, so that
+# views that were opened together don't all refresh at the same moment:
+#
+JITTER = 0.1
+
+# Don't refresh more often than this, in seconds:
+#
+MIN_INTERVAL = 1
+
+
+class Watch():
+    """
+    Refreshes one view on a timer
+
+    Only one refresh is ever in flight; a tick that comes round while the
+    last refresh is still running is simply dropped. While the view can't be
+    seen the refresh is put off, and then run once as soon as the view is
+    shown again, however many ticks were missed.
+    """
+
+    def __init__(self, view, interval, data_key):
+        self.view = view
+        self.interval = max(interval, MIN_INTERVAL)
+        self.data_key = data_key
+        self.due = False
+        self.running = False
+
+    def schedule(self):
+
+        delay = self.interval * random.uniform(1 - JITTER, 1 + JITTER)
+        sublime.set_timeout(self.tick, int(delay * 1000))
+
+    def tick(self):
+
+        # Stop if the view has gone, or is now being watched by another
+        # Watch:
+        #
+        view = self.view
+        if watches.get(view.id()) is not self:
+            return
+        if not view.is_valid() or not view.settings().has(self.data_key + '_data'):
+            stop(view)
+            return
+
+        if is_visible(view):
+            self.refresh()
+        else:
+            self.due = True
+
+        self.schedule()
+
+    def refresh(self):
+
+        self.due = False
+        if self.running:
+            return
+
+        self.running = True
+        self.view.run_command('shell_command_refresh', {'priority': 'watch'})
+
+
+# The views that are being refreshed, keyed on view ID:
+#
+if 'watches' not in globals():
+    watches = {}
+
+
+def is_visible(view):
+    '''Whether view is showing in any window, either in a group or as a panel.'''
+
+    view_id = view.id()
+    for window in sublime.windows():
+        for group in range(window.num_groups()):
+            active = window.active_view_in_group(group)
+            if active is not None and active.id() == view_id:
+                return True
+
+        if hasattr(window, 'active_panel'):
+            panel = window.active_panel() or ''
+            if panel.startswith('output.'):
+                output = window.find_output_panel(panel[len('output.'):])
+                if output is not None and output.id() == view_id:
+                    return True
+
+    return False
+
+
+def start(view, interval, data_key):
+    '''Refresh view every interval seconds, unless it already is.'''
+
+    watch = watches.get(view.id())
+    if watch is not None and watch.interval == max(interval, MIN_INTERVAL):
+        return
+
+    watch = Watch(view, interval, data_key)
+    watches[view.id()] = watch
+    watch.schedule()
+
+
+def stop(view):
+
+    watches.pop(view.id(), None)
+
+
+def finished(view):
+    '''Note that a refresh of view has finished, so the next one can run.'''
+
+    watch = watches.get(view.id())
+    if watch is not None:
+        watch.running = False
+
+
+def activated(view):
+    '''Catch up on a refresh that was put off while view was hidden.'''
+
+    watch = watches.get(view.id())
+    if watch is not None and watch.due:
+        watch.refresh()
@@ -0,0 +1,140 @@
+# Keep track of the error locations that appear in a command's output, so
+# that we can move between them without having to search the buffer:
+#
+import bisect
+import re
+
+
+class ErrorIndex():
+    """
+    Builds an index of error locations from output as it is written
+
+    :param file_regex:
+        A regular expression that picks out the file name, and optionally
+        the line number, column number and message, in that order
+
+    :param line_regex:
+        A regular expression that picks out the line number, and optionally
+        the column number and message, for lines that don't mention a file.
+        The file is taken from the most recent match of file_regex.
+
+    Both expressions work in the same way as they do in build systems.
+
+    Like Sublime's own next_result, the index keeps track of the current
+    record, so that moving to the next one starts from there, and the first
+    move starts from the top however far the output has got.
+    """
+
+    def __init__(self, file_regex=None, line_regex=None):
+        self.file_regex = re.compile(file_regex) if file_regex else None
+        self.line_regex = re.compile(line_regex) if line_regex else None
+
+        # Each record is (file, line, column, offset), and they are
+        # appended in the order that they appear in the buffer, so the
+        # list of offsets is always sorted:
+        #
+        self.records = []
+        self.offsets = []
+        self.current_file = None
+        self.current = None
+
+        # Any trailing text that doesn't yet end in a newline:
+        #
+        self._partial = ''
+        self._partial_offset = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def feed(self, text, offset):
+        '''Index the complete lines in text, which starts at offset in the buffer.'''
+
+        if self._partial:
+            text = self._partial + text
+            offset = self._partial_offset
+
+        end = text.rfind('\n') + 1
+        self._partial = text[end:]
+        self._partial_offset = offset + end
+
+        for line in text[:end].splitlines(True):
+            self._match(line.rstrip('\r\n'), offset)
+            offset += len(line)
+
+    def discard_partial(self):
+        '''Forget any incomplete line, since it has been removed from the buffer.'''
+
+        self._partial = ''
+
+    def _match(self, line, offset):
+
+        groups = None
+
+        if self.file_regex is not None:
+            match = self.file_regex.search(line)
+            if match is not None:
+                groups = match.groups()
+                self.current_file = groups[0] if groups else None
+                groups = groups[1:]
+
+        if groups is None and self.line_regex is not None and self.current_file is not None:
+            match = self.line_regex.search(line)
+            if match is not None:
+                groups = match.groups()
+
+        # There's only something to jump to if we have a line number:
+        #
+        if groups and self.current_file and groups[0] and groups[0].isdigit():
+            column = groups[1] if len(groups) > 1 and groups[1] and groups[1].isdigit() else 1
+            self.records.append((self.current_file, int(groups[0]), int(column), offset))
+            self.offsets.append(offset)
+
+    def next(self, pos=None):
+        '''Move to the record after the current one, and return it.
+
+        If pos is given, and isn't the start of the current record, then
+        the user has moved elsewhere, so move to the first record at or
+        after pos instead.
+        '''
+
+        if self.current is None:
+            idx = 0
+        elif self._moved(pos):
+            idx = bisect.bisect_left(self.offsets, pos)
+        else:
+            idx = self.current + 1
+
+        return self._select(idx)
+
+    def previous(self, pos=None):
+        '''Move to the record before the current one, and return it.
+
+        As for next(), if pos has moved away from the current record then
+        move to the last record at or before pos instead.
+        '''
+
+        if self.current is None:
+            idx = len(self.records) - 1
+        elif self._moved(pos):
+            idx = bisect.bisect_right(self.offsets, pos) - 1
+        else:
+            idx = self.current - 1
+
+        return self._select(idx)
+
+    def _moved(self, pos):
+
+        return pos is not None and self.offsets[self.current] != pos
+
+    def _select(self, idx):
+
+        if 0 <= idx < len(self.records):
+            self.current = idx
+            return self.records[idx]
+        return None
+
+
+# The indexes for each output view, keyed on the view's ID:
+#
+if 'indexes' not in globals():
+    indexes = {}
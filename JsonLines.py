@@ -0,0 +1,131 @@
+# Render a stream of JSON records, one per line, as an aligned table:
+#
+import collections
+import json
+
+
+class _ColumnWidth():
+    """
+    The widest cell among the most recent rows of a column
+
+    Keeps a queue of (row, width) pairs in which the widths are decreasing,
+    so the widest cell in the window is always at the front, and each row is
+    added and removed at most once.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.widths = collections.deque()
+
+    def add(self, row, width):
+
+        while self.widths and self.widths[-1][1] <= width:
+            self.widths.pop()
+        self.widths.append((row, width))
+
+        while self.widths[0][0] <= row - self.window:
+            self.widths.popleft()
+
+    def get(self):
+        return self.widths[0][1] if self.widths else 0
+
+
+class TableFormatter():
+    """
+    Turns JSON lines into the rows of a table as they arrive
+
+    :param fields:
+        The fields to show, in order. A dotted name such as 'user.name'
+        picks out a nested field. If no fields are given then the fields of
+        the first record are used.
+
+    :param window:
+        The number of recent rows that column widths are worked out over,
+        so that one long value only widens the rows that are near it
+
+    :param max_width:
+        Values longer than this are cut short
+
+    :param keep:
+        The number of recent rows to keep for the quick panel
+
+    Only complete lines are parsed; anything that isn't a JSON object is
+    passed through unchanged. Memory use depends on window and keep, not on
+    how many records there are.
+    """
+
+    def __init__(self, fields=None, window=200, max_width=60, keep=0):
+        self.fields = fields
+        self.window = window
+        self.max_width = max_width
+        self.columns = None
+        self.row = 0
+        self.line = 0
+        self.partial = ''
+        self.rows = collections.deque(maxlen=keep) if keep else None
+
+    def feed(self, text, final=False):
+        '''Return the text to show for any lines that text completes.'''
+
+        text = self.partial + text
+        end = len(text) if final else text.rfind('\n') + 1
+        self.partial = text[end:]
+
+        out = []
+        for line in text[:end].splitlines():
+            out.append(self._format(line))
+            self.line += 1
+
+        return ''.join(out)
+
+    def _format(self, line):
+
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+
+        if not isinstance(record, dict):
+            return line + '\n'
+
+        header = ''
+        if self.columns is None:
+            if self.fields is None:
+                self.fields = list(record)
+            self.columns = [_ColumnWidth(self.window) for field in self.fields]
+            header = self._row(self.fields)
+            self.line += 1
+
+        row = self._row([self._cell(record, field) for field in self.fields])
+
+        if self.rows is not None:
+            self.rows.append((self.line, row.rstrip('\n')))
+
+        return header + row
+
+    def _row(self, cells):
+
+        self.row += 1
+        for column, cell in zip(self.columns, cells):
+            column.add(self.row, len(cell))
+
+        return '  '.join(cell.ljust(column.get()) for column, cell in zip(self.columns, cells)).rstrip() + '\n'
+
+    def _cell(self, record, field):
+
+        value = record
+        for name in field.split('.'):
+            value = value.get(name) if isinstance(value, dict) else None
+
+        if value is None:
+            cell = ''
+        elif isinstance(value, str):
+            cell = value
+        else:
+            cell = json.dumps(value, separators=(',', ':'))
+
+        cell = cell.replace('\n', ' ')
+        if len(cell) > self.max_width:
+            cell = cell[:self.max_width - 1] + '…'
+
+        return cell
@@ -1,42 +1,599 @@
+import codecs
+import errno
+import json
 import os
-import shlex
-import subprocess
 import threading
-import select
 
 import sublime
 
 from . import SublimeHelper as SH
+from . import Terminal
 
 
-def process(commands, callback=None, stdin=None, settings=None, working_dir=None, wait_for_completion=None, **kwargs):
+# Variables that describe the capturing shell itself, rather than the
+# environment that the configuration file sets up:
+#
+_TRANSIENT_VARIABLES = ('PWD', 'OLDPWD', 'SHLVL', '_')
+
+# The files that a login shell reads, any of which might change the
+# environment that it sets up:
+#
+_LOGIN_FILES = ('~/.profile', '~/.bash_profile', '~/.bash_login', '~/.zprofile', '~/.zshenv', '~/.zlogin', '~/.login')
+
+# The changes that shell configuration files make to the environment, keyed
+# on the shell and the file. Each entry also records the files'
+# modification times, and a digest of the environment that the changes were
+# made to, so that we know when they need capturing again:
+#
+if '_environments' not in globals():
+    _environments = None
+    _environments_lock = threading.Lock()
+
+
+def _environments_file():
+
+    return os.path.join(sublime.cache_path(), 'ShellCommand', 'environments.json')
+
+
+def _load_environments():
+
+    global _environments
+
+    if _environments is None:
+        _environments = {}
+        try:
+            with open(_environments_file()) as f:
+                _environments = json.load(f)
+        except (OSError, IOError, ValueError):
+            pass
+
+    return _environments
+
+
+def _save_environments():
+
+    # The environment may well contain credentials, so make sure that only
+    # the user can read the cache:
+    #
+    file_name = _environments_file()
+    try:
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        tmp_name = file_name + '.tmp'
+        fd = os.open(tmp_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(_environments, f)
+        os.replace(tmp_name, file_name)
+    except (OSError, IOError):
+        pass
+
+
+def _modification_times(bash_env, login):
+    '''Get the modification times of the files that set up the environment.
+
+    Returns None if bash_env doesn't exist. Login files that don't exist
+    have a time of None, so that creating one is noticed.
+    '''
+
+    mtimes = []
+
+    if bash_env is not None:
+        try:
+            mtimes.append(os.path.getmtime(os.path.expanduser(bash_env)))
+        except OSError:
+            return None
+
+    if login:
+        for file_name in _LOGIN_FILES:
+            try:
+                mtimes.append(os.path.getmtime(os.path.expanduser(file_name)))
+            except OSError:
+                mtimes.append(None)
+
+    return mtimes
+
+
+def _environment_digest(environ):
+    '''Get a digest of an environment, to tell whether it has changed.'''
+
+    import hashlib
+
+    items = sorted((name, value) for name, value in environ.items() if name not in _TRANSIENT_VARIABLES)
+    return hashlib.sha1(json.dumps(items).encode('utf-8')).hexdigest()
+
+
+def get_shell_environment(bash_env=None, executable=None, login=False):
+    '''Get the environment set up by a configuration file or login shell.
+
+    The changes that the shell makes to the environment are captured once
+    by running it, and then applied to the editor's environment until the
+    configuration files change, or the editor's environment does. Only
+    the changes are kept, so that variables such as SSH_AUTH_SOCK always
+    come from the current session. None is returned if the environment
+    can't be captured, in which case the caller should source the file
+    itself; a failure is remembered in the same way, so that a shell that
+    can't be captured isn't run again before every command.
+    '''
+
+    if os.name == 'nt':
+        return None
+
+    shell = executable or '/bin/sh'
+
+    mtimes = _modification_times(bash_env, login)
+    if mtimes is None:
+        return None
+
+    key = '{}|{}|{}'.format(shell, bash_env or '', 'login' if login else '')
+    environ = dict(os.environ)
+    digest = _environment_digest(environ)
+
+    with _environments_lock:
+        environments = _load_environments()
+        cached = environments.get(key)
+        if cached is None or cached.get('mtimes') != mtimes or cached.get('digest') != digest:
+            cached = {
+                'mtimes': mtimes,
+                'digest': digest,
+                'changes': _capture_changes(shell, bash_env, environ)
+            }
+            environments[key] = cached
+            _save_environments()
+
+    changes = cached['changes']
+    if changes is None:
+        return None
+
+    for name, value in changes.items():
+        if value is None:
+            environ.pop(name, None)
+        else:
+            environ[name] = value
+
+    return environ
+
+
+def _capture_changes(shell, bash_env, environ):
+    '''Run the shell to find out what it changes in environ.
+
+    Returns a dictionary of the variables that are set or changed, with
+    None for those that are removed, or None if the shell couldn't be run.
+    '''
+
+    # Source the file quietly, so that anything it writes doesn't get
+    # mixed up with the variables:
+    #
+    if bash_env is not None:
+        args = [shell, '-c', '. {} >/dev/null 2>&1 </dev/null; env -0'.format(bash_env)]
+    else:
+        args = [shell, '-l', '-c', 'env -0']
+
+    import subprocess
+
+    try:
+        proc = subprocess.Popen(args,
+                                stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL,
+                                env=environ)
+    except OSError:
+        return None
+
+    try:
+        output, _ = proc.communicate(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        return None
+
+    if proc.returncode != 0 or b'\0' not in output:
+        return None
+
+    env = {}
+    for item in output.decode('utf-8', 'replace').split('\0'):
+        name, sep, value = item.partition('=')
+        if sep and name not in _TRANSIENT_VARIABLES:
+            env[name] = value
+
+    changes = dict((name, value) for name, value in env.items() if environ.get(name) != value)
+    for name in environ:
+        if name not in env and name not in _TRANSIENT_VARIABLES:
+            changes[name] = None
+
+    return changes
+
+
+# Commands that are run in the background, such as refreshes, give way to
+# commands that the user is waiting on:
+#
+PRIORITIES = {
+    'interactive': 0,
+    'refresh': 1,
+    'watch': 2
+}
+
+# A command that is still running can only be shared while its output so
+# far is kept for anyone who joins late. Once there is more than this much
+# of it, in characters, it's let go and the command is no longer shared:
+#
+MAX_SHARED_OUTPUT = 1024 * 1024
+
+
+class Job():
+    """
+    A command that has been submitted to the scheduler
+
+    The output of the command is passed on to each of the job's subscribers,
+    so that an identical command that is submitted while this one is still
+    running can share its output rather than running again. Only a job that
+    can be shared keeps a copy of its output, for subscribers that join
+    after it has started. If exit_status is set then subscribers are told
+    the command's exit status when it finishes.
+    """
+
+    def __init__(self, key, kwargs, window_id=None, priority=None, profile=None, exit_status=None):
+        self.key = key
+        self.kwargs = kwargs
+        self.window_id = window_id
+        self.profile = profile
+        self.exit_status = exit_status is True
+        self.priority = PRIORITIES.get(priority, 0)
+        self.subscribers = []
+        self.history = [] if key is not None else None
+        self.history_size = 0
+        self.attaching = 0
+        self.lock = threading.Lock()
+
+    def run(self):
+
+        target = _process
+        if self.profile is not None:
+            target = self.profile.wrap('process', _process)
+
+        # Make sure that subscribers hear that the command has finished,
+        # and that its slot is freed up, even if something goes wrong. This
+        # is only done once target() has returned, so that a profile of it
+        # has been switched off before anyone gets to read it:
+        #
+        status = None
+        try:
+            status = target(callback=self.emit, **self.kwargs)
+        finally:
+            SH.main_thread(self.emit, None, status=status)
+
+    def attach(self, callback, kwargs):
+        '''Add a subscriber, first passing it any output it has missed.'''
+
+        with self.lock:
+            history = list(self.history or [])
+            self.subscribers.append((callback, kwargs))
+
+        with scheduler.lock:
+            self.attaching -= 1
+
+        for output, stream in history:
+            _call(callback, output, stream, kwargs)
+
+    def emit(self, output, stream=None, status=None):
+
+        with self.lock:
+            if self.history is not None:
+                self.history.append((output, stream))
+                self.history_size += len(output) if isinstance(output, str) else 0
+            subscribers = list(self.subscribers)
+
+        if output is None:
+            scheduler.release(self)
+            if self.exit_status:
+                subscribers = [(callback, dict(kwargs, status=status)) for callback, kwargs in subscribers]
+        elif self.history is not None and self.history_size > MAX_SHARED_OUTPUT:
+            scheduler.unshare(self)
+
+        for callback, kwargs in subscribers:
+            _call(callback, output, stream, kwargs)
+
+
+def _call(callback, output, stream, kwargs):
+    '''Pass output to a callback, along with its stream if it isn't stdout.
+
+    Callers that don't ask for stderr to be separate are never given the
+    stream argument, so their callbacks don't need to accept it.
+    '''
+
+    if stream is None:
+        callback(output, **kwargs)
+    else:
+        callback(output, stream=stream, **kwargs)
+
+
+class Scheduler():
+    """
+    Decides when submitted commands get to run
+
+    Limits how many commands can run at once, both overall and for each
+    window, starts waiting commands in order of priority, and makes sure
+    that identical commands share one process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.settings = None
+        self.jobs = {}
+        self.pending = []
+        self.running = {}
+        self.total = 0
+        self.sequence = 0
+
+    def submit(self, callback, kwargs, settings=None, window_id=None, priority=None, profile=None, **process_kwargs):
+
+        key = repr(sorted(process_kwargs.items()))
+
+        # A command that is being profiled always gets its own process, as
+        # does one whose output is filtered, since the filter belongs to
+        # just the one caller:
+        #
+        if profile is not None or process_kwargs.get('output_filter') is not None:
+            key = None
+
+        # Whether to report the exit status is up to the job rather than
+        # the process, but it still keeps apart jobs that differ in it:
+        #
+        exit_status = process_kwargs.pop('exit_status', None)
+
+        with self.lock:
+            if settings is not None:
+                self.settings = settings
+
+            # If the same command is already running, or waiting to run,
+            # then just listen in on its output:
+            #
+            job = self.jobs.get(key)
+            if job is None:
+                process_kwargs['settings'] = settings
+                job = Job(key, process_kwargs, window_id=window_id, priority=priority, profile=profile, exit_status=exit_status)
+                if key is not None:
+                    self.jobs[key] = job
+                self.sequence += 1
+                self.pending.append((job.priority, self.sequence, job))
+                self.pending.sort(key=lambda item: item[:2])
+            job.attaching += 1
+
+        # The subscriber is added on the same thread that the output is
+        # delivered on, so that nothing gets missed or seen twice:
+        #
+        SH.main_thread(job.attach, callback, kwargs)
+
+        self.dispatch()
+
+    def dispatch(self):
+        '''Start as many waiting jobs as the limits allow.'''
+
+        max_total = None
+        max_window = None
+        if self.settings is not None:
+            max_total = self.settings.get('max_concurrent_commands')
+            max_window = self.settings.get('max_concurrent_commands_per_window')
+
+        with self.lock:
+            ready = []
+            for item in list(self.pending):
+                job = item[2]
+                if max_total and self.total >= max_total:
+                    break
+                if max_window and self.running.get(job.window_id, 0) >= max_window:
+                    continue
+                self.pending.remove(item)
+                self.total += 1
+                self.running[job.window_id] = self.running.get(job.window_id, 0) + 1
+                ready.append(job)
+
+        for job in ready:
+            thread = threading.Thread(target=job.run, daemon=True)
+            thread.start()
+
+    def unshare(self, job):
+        '''Stop sharing a job, and let go of the output it has kept.'''
+
+        with self.lock:
+
+            # Anyone who is about to join needs the output so far, so wait
+            # until they have it:
+            #
+            if job.attaching:
+                return
+            if self.jobs.get(job.key) is job:
+                del self.jobs[job.key]
+
+        with job.lock:
+            job.history = None
+
+    def release(self, job):
+        '''Free up the slot used by a job, and start any that are waiting.'''
+
+        with self.lock:
+            if self.jobs.get(job.key) is job:
+                del self.jobs[job.key]
+            self.total -= 1
+            self.running[job.window_id] -= 1
+            if self.running[job.window_id] == 0:
+                del self.running[job.window_id]
+
+        self.dispatch()
+
+
+if 'scheduler' not in globals():
+    scheduler = Scheduler()
+
+
+def process(commands, callback=None, stdin=None, settings=None, working_dir=None, wait_for_completion=None, window_id=None, priority=None, profile=None, pty=None, output_filter=None, stderr=None, exit_status=None, **kwargs):
 
     # If there's no callback method then just return the output as
     # a string:
     #
     if callback is None:
-        return _process(commands, stdin=stdin, settings=settings, working_dir=working_dir, wait_for_completion=wait_for_completion, **kwargs)
+        target = _process
+        if profile is not None:
+            target = profile.wrap('process', _process)
+        return target(commands, stdin=stdin, settings=settings, working_dir=working_dir, wait_for_completion=wait_for_completion, pty=pty, output_filter=output_filter, stderr=stderr, **kwargs)
 
-    # If there is a callback then run this asynchronously:
+    # If there is a callback then run this asynchronously, once the
+    # scheduler has room for it. As before, any extra arguments are
+    # not passed on to an asynchronous callback. If exit_status is True
+    # then the final call, with None, is also given status=, which is
+    # the exit status of the commands, or None if they couldn't be run:
     #
     else:
-        thread = threading.Thread(target=_process, kwargs={
-            'commands': commands,
-            'callback': callback,
-            'stdin': stdin,
-            'settings': settings,
-            'working_dir': working_dir,
-            'wait_for_completion': wait_for_completion
-        })
-        thread.start()
+        scheduler.submit(callback, {},
+                         settings=settings,
+                         window_id=window_id,
+                         priority=priority,
+                         profile=profile,
+                         commands=commands,
+                         stdin=stdin,
+                         working_dir=working_dir,
+                         wait_for_completion=wait_for_completion,
+                         pty=pty,
+                         output_filter=output_filter,
+                         stderr=stderr,
+                         exit_status=exit_status)
+
+
+def _write_stdin(proc, stdin):
+    '''Write stdin to the process and close it, without blocking the reader.'''
+
+    def _write():
+        try:
+            if stdin is not None:
+                proc.stdin.write(stdin.encode('utf-8'))
+        except OSError:
+            # The command has exited without reading all of its input:
+            #
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+
+    # Small amounts of input fit in the pipe's buffer so can be written
+    # straight away. Anything bigger gets its own thread, since the command
+    # may fill its output pipe before it has read all of its input:
+    #
+    if stdin is None or len(stdin) < 1024:
+        _write()
+        return None
+
+    writer = threading.Thread(target=_write, daemon=True)
+    writer.start()
+    return writer
 
 
-def _process(commands, callback=None, stdin=None, settings=None, working_dir=None, wait_for_completion=None, **kwargs):
-    '''Process one or more OS commands.'''
+def _read(fd):
+    '''Read whatever output is available, returning b'' at the end.'''
+
+    try:
+        return os.read(fd, 65536)
+    except OSError as e:
+
+        # Once the command has closed a pseudo-terminal, Linux reports an
+        # error rather than the end of the file:
+        #
+        if e.errno == errno.EIO:
+            return b''
+        raise
+
+
+class _Stream():
+    """
+    One of a command's output streams, turned into text as it is read
+
+    :param fd:
+        The file descriptor to read from
+
+    :param name:
+        The name to give the stream's output when it is passed on, or None
+        for stdout
+
+    :param output_filter:
+        An optional filter for the text, as for _process()
+    """
+
+    def __init__(self, fd, name=None, output_filter=None):
+        self.fd = fd
+        self.name = name
+        self.output_filter = output_filter
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.carriage_returns = Terminal.CarriageReturnFilter()
+
+    def read(self):
+        '''Return the text for whatever was read, and whether it was the end.'''
+
+        data = _read(self.fd)
+        final = not data
+        output = self.carriage_returns.feed(self.decoder.decode(data, final), final)
+        if self.output_filter is not None:
+            output = self.output_filter.feed(output, final)
+
+        return output, final
+
+
+def _open_pty(settings=None):
+    '''Open a pseudo-terminal, sized according to the settings.'''
+
+    import fcntl
+    import pty
+    import struct
+    import termios
+
+    columns = rows = None
+    if settings is not None:
+        columns = settings.get('pty_columns')
+        rows = settings.get('pty_rows')
+
+    master, slave = pty.openpty()
+    fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack('HHHH', rows or 24, columns or 80, 0, 0))
+
+    return master, slave
+
+
+def _process(commands, callback=None, stdin=None, settings=None, working_dir=None, wait_for_completion=None, pty=None, output_filter=None, stderr=None, **kwargs):
+    '''Process one or more OS commands.
+
+    If output_filter is provided then its feed() method is given each chunk
+    of stdout, and what it returns is passed on instead. This happens on
+    the reader thread, so it can do work that would hold up the editor.
+
+    If stderr is 'separate' then stderr is read from its own pipe, and its
+    output is passed to the callback with stream='stderr'. Otherwise it is
+    merged into stdout.
+
+    If there is a callback then it's up to the caller to tell it that the
+    commands have finished, once this returns. The exit status is returned,
+    which is that of the last command that failed, or 0 if they all worked.
+    '''
+
+    # Every module in the package is loaded when Sublime starts, so
+    # subprocess isn't imported until there's a command to run:
+    #
+    import subprocess
 
     if wait_for_completion is None:
         wait_for_completion = False
 
+    # A pseudo-terminal is only available on Posix systems:
+    #
+    if pty is not True or os.name != 'posix':
+        pty = False
+
+    # Reading both streams from one thread needs a selector that works with
+    # pipes, which Windows doesn't have, so there stderr is always merged:
+    #
+    separate_stderr = stderr == 'separate' and os.name == 'posix'
+    if separate_stderr:
+        try:
+            import selectors
+        except ImportError:
+            separate_stderr = False
+
     # We're expecting a list of commands, so if we only have one, convert
     # it to a list:
     #
@@ -44,6 +601,7 @@ def _process(commands, callback=None, stdin=None, settings=None, working_dir=Non
         commands = [commands]
 
     results = []
+    status = 0
 
     # Windows needs STARTF_USESHOWWINDOW in order to start the process with a
     # hidden window.
@@ -57,93 +615,169 @@ def _process(commands, callback=None, stdin=None, settings=None, working_dir=Non
         startupinfo = subprocess.STARTUPINFO()
         startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
 
+    # See if there are any interactive shell settings that we could use:
+    #
+    bash_env = None
+    if settings is not None and settings.has('shell_configuration_file'):
+        bash_env = settings.get('shell_configuration_file')
+    else:
+        bash_env = os.getenv('ENV')
+
+    login = settings is not None and settings.get('shell_login_environment') is True
+
+    # Work out whether the executable is being overridden in the
+    # configuration settings or an environment variable:
+    #
+    # NOTE: We don't need to check COMSPEC on Windows since this
+    # is already done inside Popen().
+    #
+    executable = None
+    if settings is not None and settings.has('shell-file-name'):
+        executable = settings.get('shell-file-name')
+    else:
+        executable = os.getenv('SHELL')
+
+    # Rather than sourcing the configuration file before every command,
+    # use the environment that it creates:
+    #
+    env = None
+    if bash_env is not None or login:
+        env = get_shell_environment(bash_env, executable, login)
+
     # Now we can execute each command:
     #
     for command in commands:
 
-        # See if there are any interactive shell settings that we could use:
+        # If the environment couldn't be captured then fall back to
+        # sourcing the configuration file:
         #
-        bash_env = None
-        if settings is not None and settings.has('shell_configuration_file'):
-            bash_env = settings.get('shell_configuration_file')
-        else:
-            bash_env = os.getenv('ENV')
-
-        if bash_env is not None:
+        if env is None and bash_env is not None:
             command = '. {}; {}'.format(bash_env, command)
 
-        # Work out whether the executable is being overridden in the
-        # configuration settings or an environment variable:
+        # If the command is to be run in a pseudo-terminal then it writes
+        # to that rather than to a pipe. Most programs only buffer a line
+        # at a time when they are writing to a terminal:
         #
-        # NOTE: We don't need to check COMSPEC on Windows since this
-        # is already done inside Popen().
-        #
-        executable = None
-        if settings is not None and settings.has('shell-file-name'):
-            executable = settings.get('shell-file-name')
-        else:
-            executable = os.getenv('SHELL')
+        master = slave = selector = None
+        stdout = subprocess.PIPE
+        if pty is True:
+            master, slave = _open_pty(settings)
+            stdout = slave
 
         try:
 
             proc = subprocess.Popen(command,
                                     executable=executable,
                                     stdin=subprocess.PIPE,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.STDOUT,
+                                    stdout=stdout,
+                                    stderr=subprocess.PIPE if separate_stderr else subprocess.STDOUT,
                                     shell=True,
                                     cwd=working_dir,
+                                    env=env,
                                     startupinfo=startupinfo)
 
-            if stdin is not None:
-                proc.stdin.write(stdin.encode('utf-8'))
-                proc.stdin.close();
+        except OSError as e:
+
+            if master is not None:
+                os.close(master)
 
-            # We're going to keep polling the command and either:
+            if e.errno == 2:
+                sublime.message_dialog('Command not found\n\nCommand is: %s' % command)
+                status = 127
+                continue
+            else:
+                raise e
+
+        finally:
+
+            # The child has its own copy of the terminal now:
             #
-            #   1. we get None to tell us that the command is still running, or;
-            #   2. we get a return code to indicate that the command has finished.
+            if slave is not None:
+                os.close(slave)
+
+        try:
+
+            # Pass on any input, and then close the command's stdin so that
+            # it doesn't sit waiting for more:
             #
-            return_code = None
-            while return_code is None:
-                return_code = proc.poll()
+            writer = _write_stdin(proc, stdin)
 
+            # Process the output as it becomes available, until the command
+            # closes it. We read whatever is there rather than waiting for
+            # whole lines, so that partial lines and progress bars show up
+            # straight away:
+            #
+            fd = master if master is not None else proc.stdout.fileno()
+            streams = [_Stream(fd, output_filter=output_filter)]
+
+            # If stderr has its own pipe then wait on both at once, and read
+            # from each as soon as it's ready, so that the output is passed
+            # on in the order that it arrived:
+            #
+            if proc.stderr is not None:
+                streams.append(_Stream(proc.stderr.fileno(), 'stderr'))
+                selector = selectors.DefaultSelector()
+                for stream in streams:
+                    selector.register(stream.fd, selectors.EVENT_READ, stream)
 
-                # If there's no error then see what we got from the command:
-                #
-                if return_code is None or return_code == 0:
-                    # Process whatever output we can get:
+            while streams:
+                if selector is None:
+                    ready = streams
+                else:
+                    ready = [key.data for key, events in selector.select()]
+
+                for stream in ready:
+                    output, final = stream.read()
+
+                    # If the caller wants everything in one go, or
+                    # there is no callback function, then batch up
+                    # the output. Otherwise pass it back to the
+                    # caller as it becomes available:
                     #
-                    output = True
-                    while output:
-                        output = proc.stdout.readline().decode().replace('\r\n', '\n')
-
-                        # If the caller wants everything in one go, or
-                        # there is no callback function, then batch up
-                        # the output. Otherwise pass it back to the
-                        # caller as it becomes available:
-                        #
+                    if output:
                         if wait_for_completion is True or callback is None:
-                            results += output
-                        else:
+                            results.append(output)
+                        elif stream.name is None:
                             SH.main_thread(callback, output, **kwargs)
+                        else:
+                            SH.main_thread(callback, output, stream=stream.name, **kwargs)
+
+                    if final:
+                        streams.remove(stream)
+                        if selector is not None:
+                            selector.unregister(stream.fd)
+
+            if proc.wait() != 0:
+                status = proc.returncode
+            if writer is not None:
+                writer.join()
 
         except subprocess.CalledProcessError as e:
 
             SH.main_thread(callback, e.returncode)
 
-        except OSError as e:
+        finally:
 
-            if e.errno == 2:
-                sublime.message_dialog('Command not found\n\nCommand is: %s' % command)
+            # Whatever happened, don't leave pipes open or the process
+            # running:
+            #
+            if selector is not None:
+                selector.close()
+            if master is not None:
+                os.close(master)
             else:
-                raise e
+                proc.stdout.close()
+            if proc.stderr is not None:
+                proc.stderr.close()
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
 
-    # Concatenate all of the results and return the value. If we've been
-    # using the callback then just make one last call with 'None' to indicate
-    # that we're finished:
+    # Concatenate all of the results, applying any carriage returns that
+    # separate the chunks, and return the value, or pass it to the callback
+    # if we've been asked to wait for completion:
     #
-    result = ''.join(results)
+    _, result = Terminal.collapse_carriage_returns(''.join(results))
 
     if callback is None:
         return result
@@ -151,4 +785,4 @@ def _process(commands, callback=None, stdin=None, settings=None, working_dir=Non
     if wait_for_completion is True:
         SH.main_thread(callback, result, **kwargs)
 
-    SH.main_thread(callback, None, **kwargs)
+    return status
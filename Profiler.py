@@ -0,0 +1,122 @@
+# Opt-in profiling of the code that runs a command and renders its output.
+#
+# The profiling modules are slow to import and most sessions never use them,
+# so they are only imported once profiling is switched on:
+#
+import io
+import threading
+
+
+# Allocations are traced for as long as any session needs them. If tracing
+# was already running when the first session started then it's left alone:
+#
+if '_tracing_sessions' not in globals():
+    _tracing_lock = threading.Lock()
+    _tracing_sessions = 0
+    _started_tracing = False
+
+
+def _start_tracing(tracemalloc):
+
+    global _tracing_sessions, _started_tracing
+
+    with _tracing_lock:
+        if _tracing_sessions == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+        _tracing_sessions += 1
+
+
+def _stop_tracing(tracemalloc):
+
+    global _tracing_sessions, _started_tracing
+
+    with _tracing_lock:
+        _tracing_sessions -= 1
+        if _tracing_sessions == 0 and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+
+
+class Session():
+    """
+    Collects CPU and memory profiles for one run of a command
+
+    :param name:
+        The name to show at the top of the report
+
+    Each function that is wrapped gets its own profile, so the report shows
+    separately how much time went on reading from the process, handling the
+    output callbacks, and drawing into the view. Allocations are only
+    reported where tracemalloc is available, which it isn't in Sublime's
+    Python 3.3 plugin host.
+    """
+
+    def __init__(self, name):
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+
+        self.name = name
+        self.profiles = {}
+        self.lock = threading.Lock()
+        self.tracemalloc = tracemalloc
+        self.snapshot = None
+
+        if tracemalloc is not None:
+            _start_tracing(tracemalloc)
+            self.snapshot = tracemalloc.take_snapshot()
+
+    def wrap(self, label, fn):
+        '''Return a version of fn that is profiled under label.'''
+
+        import cProfile
+
+        with self.lock:
+            profile = self.profiles.setdefault(label, cProfile.Profile())
+
+        def _wrapper(*args, **kwargs):
+
+            # Only one profiler can be active at a time, so if another is
+            # already running then just call the function:
+            #
+            try:
+                profile.enable()
+            except ValueError:
+                return fn(*args, **kwargs)
+
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profile.disable()
+
+        return _wrapper
+
+    def report(self, limit=20):
+        '''Get the hot spots and the allocation sites as text.'''
+
+        import pstats
+
+        out = io.StringIO()
+        out.write('Profile of {}\n\n'.format(self.name))
+
+        for label in sorted(self.profiles):
+            out.write('== {} ==\n'.format(label))
+            stats = pstats.Stats(self.profiles[label], stream=out)
+            stats.sort_stats('cumulative').print_stats(limit)
+
+        tracemalloc = self.tracemalloc
+        if self.snapshot is not None:
+            if tracemalloc.is_tracing():
+                out.write('== allocations ==\n\n')
+                snapshot = tracemalloc.take_snapshot().filter_traces([
+                    tracemalloc.Filter(False, tracemalloc.__file__)
+                ])
+                for stat in snapshot.compare_to(self.snapshot, 'lineno')[:limit]:
+                    out.write('{}\n'.format(stat))
+
+            self.snapshot = None
+            _stop_tracing(tracemalloc)
+
+        return out.getvalue()
@@ -1,10 +1,24 @@
+import itertools
+import os
+
 import sublime
+import sublime_plugin
 
+from . import AutoRefresh
+from . import Diagnostics
 from . import SublimeHelper as SH
 from . import OsShell
+from . import Terminal
 from .hist import history
 
 
+# Each run of a command over several regions tracks its regions under a key
+# of its own, so that runs in the same view don't disturb each other:
+#
+if 'each_runs' not in globals():
+    each_runs = itertools.count()
+
+
 class ShellCommandCommand(SH.TextCommand):
 
     def __init__(self, plugin, default_prompt=None, **kwargs):
@@ -17,7 +31,7 @@ class ShellCommandCommand(SH.TextCommand):
         self.data_key = 'ShellCommand'
         self.output_written = False
 
-    def run(self, edit, command=None, command_prefix=None, prompt=None, region=None, arg_required=None, stdin=None, panel=None, target=None, title=None, syntax=None, refresh=None, wait_for_completion=None, root_dir=False):
+    def run(self, edit, command=None, command_prefix=None, prompt=None, region=None, arg_required=None, stdin=None, panel=None, target=None, title=None, syntax=None, refresh=None, wait_for_completion=None, root_dir=False, file_regex=None, line_regex=None, pty=None, output_format=None, fields=None, quick_panel=None, interval=None, stderr=None):
 
         view, window = self.get_view_and_window()
 
@@ -54,6 +68,13 @@ class ShellCommandCommand(SH.TextCommand):
         if region == 'stdin' and stdin is None:
             stdin = self.get_region(can_select_entire_buffer=True)
 
+        # If the command should be run once for each region then keep
+        # hold of the regions, so that each can be replaced by its output:
+        #
+        regions = None
+        if region == 'each':
+            regions = self.get_regions()
+
         # Setup a closure to run the command:
         #
         def _C1(commands):
@@ -71,7 +92,10 @@ class ShellCommandCommand(SH.TextCommand):
                 commands[idx] = command
 
             history.insert('; '.join(commands))
-            self.run_shell_command(commands, stdin=stdin, panel=panel, target=target, title=title, syntax=syntax, refresh=refresh, wait_for_completion=wait_for_completion, root_dir=root_dir)
+            if regions is not None:
+                self.run_shell_command_each(commands, regions, root_dir=root_dir)
+                return
+            self.run_shell_command(commands, stdin=stdin, panel=panel, target=target, title=title, syntax=syntax, refresh=refresh, wait_for_completion=wait_for_completion, root_dir=root_dir, file_regex=file_regex, line_regex=line_regex, pty=pty, output_format=output_format, fields=fields, quick_panel=quick_panel, interval=interval, stderr=stderr)
 
         # If no command is specified then we prompt for one, otherwise
         # we can just execute the command:
@@ -135,7 +159,7 @@ class ShellCommandCommand(SH.TextCommand):
             else:
                 _on_input_end({})
 
-    def run_shell_command(self, command=None, stdin=None, panel=False, target=None, title=None, syntax=None, refresh=False, console=None, working_dir=None, wait_for_completion=None, root_dir=False):
+    def run_shell_command(self, command=None, stdin=None, panel=False, target=None, title=None, syntax=None, refresh=False, console=None, working_dir=None, wait_for_completion=None, root_dir=False, file_regex=None, line_regex=None, priority=None, pty=None, output_format=None, fields=None, quick_panel=None, interval=None, stderr=None):
 
         view, window = self.get_view_and_window()
 
@@ -148,36 +172,80 @@ class ShellCommandCommand(SH.TextCommand):
         if working_dir is None:
             working_dir = self.get_working_dir(root_dir=root_dir)
 
+        if pty is None:
+            pty = settings.get('pty')
+
+        if stderr is None:
+            stderr = settings.get('stderr')
+
+        # Any options that are needed to run the command again when the
+        # output is refreshed:
+        #
+        options = {
+            'pty': pty,
+            'output_format': output_format,
+            'fields': fields,
+            'quick_panel': quick_panel,
+            'interval': interval,
+            'stderr': stderr
+        }
+
+        # If the output is JSON lines then it's turned into a table as it's
+        # read, keeping the most recent rows if they are to be shown in a
+        # quick panel:
+        #
+        output_filter = None
+        if output_format == 'jsonl':
+            from . import JsonLines
+            output_filter = JsonLines.TableFormatter(fields=fields,
+                                                     window=settings.get('jsonl_width_window') or 200,
+                                                     max_width=settings.get('jsonl_max_column_width') or 60,
+                                                     keep=(settings.get('jsonl_quick_panel_size') or 1000) if quick_panel is True else 0)
+
         # Run the command and write any output to the buffer:
         #
         message = self.default_prompt + ': (' + ''.join(command)[:20] + ')'
 
-        self.finished = False
-        self.output_target = None
-        self.output_written = False
+        # The state of this run is kept here rather than on the command,
+        # since Sublime uses one command object for each view, and the same
+        # command can be run again from the view before this run finishes:
+        #
+        finished = False
+        output_target = None
+        output_written = False
 
         # Start our progress bar in the initiating window. If a new window
         # gets opened then the progress bar will get moved to that:
         #
-        self.progress = SH.ProgressDisplay(view, message, message,
+        progress = SH.ProgressDisplay(view, message, message,
           settings.get('progress_display_heartbeat'))
-        self.progress.start()
+        progress.start()
 
         # Grab the config setting that determines whether to scroll the end of the view
         # so that it's visible:
         #
         scroll_show_maximum_output = settings.get('comint-scroll-show-maximum-output')
 
-        def _C2(output):
+        # If profiling has been switched on then collect profiles for this
+        # run, to be written out when the command finishes:
+        #
+        profile = None
+        if settings.get('profile') is True:
+            from . import Profiler
+            profile = Profiler.Session(message)
+
+        def _C2(output, stream=None):
+
+            nonlocal finished, output_target, output_written, progress
 
             # If output is None then the command has finished:
             #
             if output is None:
-                self.finished = True
+                finished = True
 
                 # If there has been no output:
                 #
-                if self.output_written is False:
+                if output_written is False:
                     show_message = settings.get('show_success_but_no_output_message')
                     if show_message:
                         output = settings.get('success_but_no_output_message')
@@ -187,9 +255,20 @@ class ShellCommandCommand(SH.TextCommand):
                 if refresh is True:
                     view.run_command('shell_command_refresh')
 
+                # If this was a periodic refresh then the next one can go
+                # ahead:
+                #
+                if console is not None:
+                    AutoRefresh.finished(console)
+
                 # Stop the progress bar:
                 #
-                self.progress.stop()
+                progress.stop()
+
+                # Let the user pick from the rows of a table:
+                #
+                if output_filter is not None and output_filter.rows:
+                    self.show_rows(window, output_target, list(output_filter.rows))
 
             # If there is something to output...
             #
@@ -198,12 +277,12 @@ class ShellCommandCommand(SH.TextCommand):
                 # ...only allow blank lines if something else has already been
                 # written:
                 #
-                if self.output_written is True or len(output.strip()) > 0:
+                if output_written is True or len(output.strip()) > 0:
 
                     # If no output window has been created yet then create one now:
                     #
-                    if self.output_target is None:
-                        self.output_target = SH.OutputTarget(window,
+                    if output_target is None:
+                        output_target = SH.OutputTarget(window,
                                                              self.data_key,
                                                              command,
                                                              working_dir,
@@ -211,23 +290,207 @@ class ShellCommandCommand(SH.TextCommand):
                                                              syntax=syntax,
                                                              panel=panel,
                                                              console=console,
-                                                             target=target)
+                                                             target=target,
+                                                             ansi_colors=settings.get('ansi_colors'),
+                                                             file_regex=file_regex,
+                                                             line_regex=line_regex,
+                                                             profile=profile,
+                                                             options=options,
+                                                             reuse=settings.get('reuse_output_views'),
+                                                             pool_size=settings.get('output_view_pool_size'),
+                                                             separate_stderr=stderr == 'separate',
+                                                             stderr_scope=settings.get('stderr_scope'))
 
                         # Switch our progress bar to the new window:
                         #
-                        if self.finished is False:
-                            self.progress.stop()
-                            self.progress = SH.ProgressDisplay(self.output_target, message, message,
+                        if finished is False:
+                            progress.stop()
+                            progress = SH.ProgressDisplay(output_target, message, message,
                               settings.get('progress_display_heartbeat'))
-                            self.progress.start()
+                            progress.start()
+
+                        # Keep re-running the command if an interval was
+                        # given, as long as the output is in a view of its
+                        # own that knows how to run it again:
+                        #
+                        output_view = output_target.console
+                        if interval and output_view.settings().has(self.data_key + '_data'):
+                            AutoRefresh.start(output_view, interval, self.data_key)
+                        elif console is None:
+                            AutoRefresh.stop(output_view)
 
                     # Append our output to whatever buffer is being used, and
                     # track that some output has now been written:
                     #
-                    self.output_target.append_text(output, scroll_show_maximum_output=scroll_show_maximum_output)
-                    self.output_written = True
+                    output_target.append_text(output, scroll_show_maximum_output=scroll_show_maximum_output, stream=stream)
+                    output_written = True
+
+            # The view is free for another run once this one has finished:
+            #
+            if finished is True and output_target is not None:
+                output_target.finish()
+
+            # Write the profile once the last of the output has been drawn:
+            #
+            if finished is True and profile is not None:
+                def _report():
+                    self.write_profile(profile, window, settings)
+
+                if output_target is not None:
+                    output_target.when_idle(_report)
+                else:
+                    sublime.set_timeout_async(_report, 0)
+
+        callback = _C2
+        if profile is not None:
+            callback = profile.wrap('callback', _C2)
+
+        return self.run_shell_command_raw(command, callback, stdin=stdin, settings=settings, working_dir=working_dir, wait_for_completion=wait_for_completion, window_id=window.id(), priority=priority, profile=profile, pty=pty, output_filter=output_filter, stderr=stderr)
+
+    def show_rows(self, window, output_target, rows):
+        '''Show table rows in a quick panel, moving to the row that is picked.'''
+
+        def _on_select(idx):
+            if idx == -1 or output_target is None:
+                return
+            console = output_target.console
+            pos = console.text_point(rows[idx][0], 0)
+            console.sel().clear()
+            console.sel().add(sublime.Region(pos))
+            console.show(pos)
+            window.focus_view(console)
+
+        window.show_quick_panel([row for line, row in rows], _on_select)
+
+    def write_profile(self, profile, window, settings):
+        '''Write a profile report to a file, or to a new view.'''
+
+        report = profile.report()
+
+        file_name = settings.get('profile_output')
+        if file_name:
+            with open(os.path.expanduser(file_name), 'a') as f:
+                f.write(report)
+        else:
+            view = window.new_file()
+            view.set_name('*ShellCommand Profile*')
+            view.set_scratch(True)
+            view.run_command('sublime_helper_insert_text', {'pos': 0, 'msg': report})
+
+    def run_shell_command_each(self, command, regions, working_dir=None, root_dir=False):
+        '''Run a command once for each region, replacing the region with the output.'''
+
+        view, window = self.get_view_and_window()
+
+        settings = sublime.load_settings('ShellCommand.sublime-settings')
+
+        if working_dir is None:
+            working_dir = self.get_working_dir(root_dir=root_dir)
+
+        # Track the regions in the view, so that they stay in the right
+        # place if the buffer is edited while the commands are running:
+        #
+        key = '{}_each_{}'.format(self.data_key, next(each_runs))
+        view.add_regions(key, regions, '', '', sublime.HIDDEN)
+        inputs = [view.substr(region) for region in regions]
+
+        message = self.default_prompt + ': (' + ''.join(command)[:20] + ')'
+        progress = SH.ProgressDisplay(view, message, message,
+          settings.get('progress_display_heartbeat'))
+        progress.start()
+
+        # Each region's output, and whether its command worked, which is
+        # only known once it has finished:
+        #
+        outputs = [[] for _ in inputs]
+        failed = [True for _ in inputs]
+        waiting = list(range(len(inputs)))
+        running = 0
+
+        # The commands go through the scheduler like any other, so they
+        # count towards its limits, but no more than this many are given to
+        # it at once, in case there are hundreds of cursors:
+        #
+        batch_size = settings.get('max_concurrent_commands') or 8
+
+        def _start():
+
+            nonlocal running
+
+            while waiting and running < batch_size:
+                idx = waiting.pop(0)
+                running += 1
+                try:
+                    self.run_shell_command_raw(command, _callback(idx), stdin=inputs[idx], settings=settings, working_dir=working_dir, window_id=window.id(), stderr='separate', exit_status=True)
+                except Exception:
+
+                    # Leave this region, and any that haven't started, as
+                    # they are:
+                    #
+                    del waiting[:]
+                    running -= 1
+                    if running == 0:
+                        _C4()
+                    raise
 
-        return self.run_shell_command_raw(command, _C2, stdin=stdin, settings=settings, working_dir=working_dir, wait_for_completion=wait_for_completion, root_dir=root_dir)
+        def _callback(idx):
+
+            def _C3(output, stream=None, status=None):
+
+                nonlocal running
+
+                # Only stdout goes into the view; anything on stderr is
+                # a sign of trouble, which the exit status will confirm:
+                #
+                if output is not None:
+                    if stream is None:
+                        outputs[idx].append(output)
+                    return
+
+                failed[idx] = status != 0
+                running -= 1
+                if waiting:
+                    _start()
+                elif running == 0:
+                    _C4()
+
+            return _C3
+
+        def _C4():
+
+            progress.stop()
+
+            current = view.get_regions(key)
+            view.erase_regions(key)
+
+            # A region whose command failed keeps its text, rather than
+            # being replaced with an error message or nothing at all:
+            #
+            replacements = []
+            for region, stdin, output, failure in zip(current, inputs, outputs, failed):
+                if failure:
+                    continue
+                _, output = Terminal.collapse_carriage_returns(''.join(output))
+
+                # Don't add a trailing newline that wasn't in the original
+                # text:
+                #
+                if output.endswith('\n') and not stdin.endswith('\n'):
+                    output = output[:-1]
+                replacements.append([region.begin(), region.end(), output])
+
+            if any(failed):
+                sublime.status_message('{} failed for {} of {} regions, which were left as they were'.format(message, sum(failed), len(failed)))
+
+            # Now replace all of the regions in one edit:
+            #
+            if len(current) == len(inputs) and replacements:
+                view.run_command('sublime_helper_replace_regions', {'regions': replacements})
+
+        if inputs:
+            _start()
+        else:
+            _C4()
 
     def run_shell_command_raw(self, *args, **kwargs):
 
@@ -237,16 +500,19 @@ class ShellCommandCommand(SH.TextCommand):
 
 class ShellCommandOnRegionCommand(ShellCommandCommand):
 
-    def run(self, edit, command=None, command_prefix=None, prompt=None, arg_required=None, panel=None, target=None, title=None, syntax=None, refresh=None):
+    def run(self, edit, command=None, command_prefix=None, prompt=None, arg_required=None, panel=None, target=None, title=None, syntax=None, refresh=None, file_regex=None, line_regex=None, pty=None, output_format=None, fields=None, quick_panel=None, interval=None, stderr=None):
 
-        ShellCommandCommand.run(self, edit, command=command, command_prefix=command_prefix, prompt=prompt, region='stdin', arg_required=True, panel=panel, target=target, title=title, syntax=syntax, refresh=refresh)
+        ShellCommandCommand.run(self, edit, command=command, command_prefix=command_prefix, prompt=prompt, region='stdin', arg_required=True, panel=panel, target=target, title=title, syntax=syntax, refresh=refresh, file_regex=file_regex, line_regex=line_regex, pty=pty, output_format=output_format, fields=fields, quick_panel=quick_panel, interval=interval, stderr=stderr)
 
 
 # Refreshing a shell command simply involves re-running the original command:
 #
 class ShellCommandRefreshCommand(ShellCommandCommand):
 
-    def run(self, edit, callback=None):
+    def run(self, edit, callback=None, priority=None):
+
+        if priority is None:
+            priority = 'refresh'
 
         console, window = self.get_view_and_window()
 
@@ -255,9 +521,92 @@ class ShellCommandRefreshCommand(ShellCommandCommand):
             data = settings.get(self.data_key + '_data', None)
             if data is not None:
 
+                # If the command is still running from last time then its
+                # output mustn't end up in the refreshed view:
+                #
+                SH.detach_target(console)
+
+                # A view that is being refreshed is in use, so it should be
+                # among the last of the output views to be closed:
+                #
+                SH.touch_output_view(console)
+
                 console.set_read_only(False)
                 console.run_command('sublime_helper_clear_buffer')
                 console.set_read_only(True)
+                SH.erase_ansi_regions(console, self.data_key)
+
+                self.run_shell_command(command=data['command'], console=console, working_dir=data['working_dir'], file_regex=data.get('file_regex'), line_regex=data.get('line_regex'), priority=priority, **data.get('options', {}))
+
+
+# Moving between errors uses the index built up as the output was written,
+# so there's no need to search the buffer:
+#
+class ShellCommandNextErrorCommand(SH.TextCommand):
+
+    def __init__(self, plugin, **kwargs):
+
+        SH.TextCommand.__init__(self, plugin, **kwargs)
+        self.data_key = 'ShellCommand'
+
+    def run(self, edit, backwards=False):
+
+        console, window = self.get_view_and_window()
+
+        index = Diagnostics.indexes.get(console.id())
+        if index is None:
+            return
+
+        # The index carries on from the error it last moved to, unless the
+        # cursor has been moved to another line since:
+        #
+        sel = console.sel()
+        pos = console.line(sel[0].begin()).begin() if len(sel) else 0
+
+        if backwards is True:
+            record = index.previous(pos)
+        else:
+            record = index.next(pos)
+
+        if record is None:
+            sublime.status_message('No more errors')
+            return
+
+        file_name, line, column, offset = record
+
+        # Highlight the error in the output...
+        #
+        sel.clear()
+        sel.add(sublime.Region(offset))
+        console.show(offset)
+
+        # ...and then open the file, relative to the directory the command
+        # was run in:
+        #
+        if not os.path.isabs(file_name):
+            working_dir = self.get_working_dir()
+            if working_dir is not None:
+                file_name = os.path.join(working_dir, file_name)
+
+        window.open_file('{}:{}:{}'.format(file_name, line, column), sublime.ENCODED_POSITION)
+
+
+class ShellCommandPreviousErrorCommand(ShellCommandNextErrorCommand):
+
+    def run(self, edit):
+
+        ShellCommandNextErrorCommand.run(self, edit, backwards=True)
+
+
+class ShellCommandViewListener(sublime_plugin.EventListener):
+
+    def on_activated(self, view):
+
+        AutoRefresh.activated(view)
+
+    def on_close(self, view):
 
-                self.run_shell_command(command=data['command'], console=console, working_dir=data['working_dir'])
+        Diagnostics.indexes.pop(view.id(), None)
+        SH.active_targets.pop(view.id(), None)
+        AutoRefresh.stop(view)
 
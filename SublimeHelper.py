@@ -1,5 +1,6 @@
 # Helper functions and classes to wrap common Sublime Text idioms:
 #
+import collections
 import functools
 import os
 import queue
@@ -7,13 +8,19 @@ import queue
 import sublime
 import sublime_plugin
 
+from . import AutoRefresh
+from . import Diagnostics
+from . import Terminal
+
 
 def main_thread(callback, *args, **kwargs):
 
     sublime.set_timeout_async(functools.partial(callback, *args, **kwargs), 0)
 
-# Work out the name of a syntax file when we may only know the syntax:
+# Work out the name of a syntax file when we may only know the syntax. Since
+# this can mean searching the resources several times, the answer is kept:
 #
+@functools.lru_cache(maxsize=None)
 def get_syntax_file(syntax):
     # First try to find the resource using the provided string:
     #
@@ -62,10 +69,10 @@ class TextCommand(sublime_plugin.TextCommand):
 
         return view, window
 
-    def get_region(self, view=None, can_select_entire_buffer=False):
-        '''Get the value under the cursor, or cursors.'''
+    def get_regions(self, view=None, can_select_entire_buffer=False):
+        '''Get the regions under the cursor, or cursors.'''
 
-        value = ''
+        regions = []
 
         view, window = self.get_view_and_window(view)
 
@@ -95,7 +102,19 @@ class TextCommand(sublime_plugin.TextCommand):
                             sublime.CLASS_WORD_START | sublime.CLASS_WORD_END,
                             ' ():'
                         )
-                    value = value + ' ' + view.substr(region)
+                    regions.append(region)
+
+        return regions
+
+    def get_region(self, view=None, can_select_entire_buffer=False):
+        '''Get the value under the cursor, or cursors.'''
+
+        value = ''
+
+        view, window = self.get_view_and_window(view)
+
+        for region in self.get_regions(view, can_select_entire_buffer=can_select_entire_buffer):
+            value = value + ' ' + view.substr(region)
 
         return value
 
@@ -195,6 +214,18 @@ class SublimeHelperEraseTextCommand(sublime_plugin.TextCommand):
         self.view.erase(edit, sublime.Region(a, b))
 
 
+# The command that is executed to replace several regions in one edit. Each
+# item is [a, b, text], and they are replaced from the end of the buffer
+# backwards so that earlier offsets are not disturbed:
+#
+class SublimeHelperReplaceRegionsCommand(sublime_plugin.TextCommand):
+
+    def run(self, edit, regions):
+
+        for a, b, text in sorted(regions, key=lambda item: item[0], reverse=True):
+            self.view.replace(edit, sublime.Region(a, b), text)
+
+
 # The command that is executed to clear a buffer:
 #
 class SublimeHelperClearBufferCommand(sublime_plugin.TextCommand):
@@ -209,19 +240,137 @@ class TimeoutStateEnum:
     Stopped, Started, Abort = range(3)
 
 
+# The maximum number of regions to keep under one key before starting another.
+# Sublime only lets us replace the regions for a key, so extending a key means
+# passing every region it already has; capping the size keeps that cost fixed
+# however long the output gets:
+#
+MAX_REGIONS_PER_KEY = 1000
+
+
+# Output views that can be reused, keyed on the window and the command or
+# title, with the least recently used first:
+#
+if 'output_views' not in globals():
+    output_views = collections.OrderedDict()
+
+
+# The output target that is currently writing to each view, keyed on view
+# ID:
+#
+if 'active_targets' not in globals():
+    active_targets = {}
+
+
+def detach_target(view):
+    '''Stop whichever run is writing to view from writing any more.'''
+
+    target = active_targets.pop(view.id(), None)
+    if target is not None:
+        target.detach()
+
+
+def erase_ansi_regions(view, data_key):
+    '''Remove the colours that an earlier run added to view.'''
+
+    settings = view.settings()
+    for idx in range(settings.get(data_key + '_ansi_keys', 0)):
+        view.erase_regions('{}_ansi_{}'.format(data_key, idx))
+    settings.erase(data_key + '_ansi_keys')
+
+
+def touch_output_view(view):
+    '''Note that view has just been used, so that it's the last to be closed.'''
+
+    for pool_key, pool_view in list(output_views.items()):
+        if pool_view.id() == view.id():
+            output_views.move_to_end(pool_key)
+
+
+def get_output_view(window, key, pool_size=None, data_key='ShellCommand'):
+    '''Get an output view for key, reusing the last one if it's still open.
+
+    A view that an earlier run is still writing to isn't reused, so that
+    the two runs' output doesn't get mixed up.
+    '''
+
+    pool_key = (window.id(), key)
+
+    view = output_views.pop(pool_key, None)
+    if view is not None and view.is_valid() and view.window() is not None and view.id() not in active_targets:
+        view.set_read_only(False)
+        view.run_command('sublime_helper_clear_buffer')
+        erase_ansi_regions(view, data_key)
+        window.focus_view(view)
+    else:
+        view = window.new_file()
+
+    output_views[pool_key] = view
+
+    # Forget about any views that have been closed, and if there are still
+    # too many then close the ones that were used least recently. A view
+    # that is still being written to, or that is being refreshed on a
+    # timer, is left open, even if that means going over the limit for now:
+    #
+    for old_key, old_view in list(output_views.items()):
+        if not old_view.is_valid() or old_view.window() is None:
+            del output_views[old_key]
+
+    if pool_size:
+        for old_key, old_view in list(output_views.items()):
+            if len(output_views) <= pool_size:
+                break
+            if old_view is view or old_view.id() in active_targets or old_view.id() in AutoRefresh.watches:
+                continue
+            del output_views[old_key]
+            old_window = old_view.window()
+            if hasattr(old_view, 'close'):
+                old_view.close()
+            else:
+                old_window.focus_view(old_view)
+                old_window.run_command('close_file')
+
+    return view
+
+
 class OutputTarget():
 
-    def __init__(self, window, data_key, command, working_dir, title=None, syntax=None, panel=False, console=None, target=None):
+    def __init__(self, window, data_key, command, working_dir, title=None, syntax=None, panel=False, console=None, target=None, ansi_colors=False, file_regex=None, line_regex=None, profile=None, options=None, reuse=False, pool_size=None, separate_stderr=False, stderr_scope=None):
 
         self.queue = queue.Queue()
         self.set_timer_status = TimeoutStateEnum.Stopped
+        self.data_key = data_key
+        self.profile = profile
+        self.idle_callbacks = []
+
+        # If colours have been asked for then escape sequences are removed
+        # from the output and the coloured spans are tracked as regions:
+        #
+        self.ansi = Terminal.AnsiParser() if ansi_colors else None
+        self.ansi_regions = {}
+        self.ansi_keys = 0
+
+        # If stderr is kept separate from stdout then it's shown in its own
+        # colour, and the bytes and lines that each stream writes are
+        # counted:
+        #
+        self.stderr_scope = stderr_scope
+        self.stream_counts = None
+        if separate_stderr:
+            self.stream_counts = collections.OrderedDict([('stdout', [0, 0]), ('stderr', [0, 0])])
+
+        # The position of the start of the line that is being written, in
+        # case a progress bar wants to redraw it:
+        #
+        self.line_start = None
 
         self.target = target
         if target == 'point' and console is None:
             console = window.active_view()
 
         # If a panel has been requested then create one and show it,
-        # otherwise create a new buffer, and set its caption:
+        # otherwise create a new buffer, or reuse the one from the last time
+        # the command was run, and set its caption:
         #
         if console is not None:
             self.console = console
@@ -230,7 +379,11 @@ class OutputTarget():
                 self.console = window.get_output_panel('ShellCommand')
                 window.run_command('show_panel', {'panel': 'output.ShellCommand'})
             else:
-                self.console = window.new_file()
+                if reuse is True:
+                    key = title if title else ' '.join(command) if isinstance(command, list) else command
+                    self.console = get_output_view(window, key, pool_size, data_key)
+                else:
+                    self.console = window.new_file()
                 caption = title if title else '*ShellCommand Output*'
                 self.console.set_name(caption)
 
@@ -255,11 +408,36 @@ class OutputTarget():
             #
             data = {
                 'command': command,
-                'working_dir': working_dir
+                'working_dir': working_dir,
+                'file_regex': file_regex,
+                'line_regex': line_regex,
+                'options': options or {}
             }
             settings.set(data_key + '_data', data)
 
-    def append_text(self, output, scroll_show_maximum_output=False):
+        # Only one run at a time writes to a view, so if an earlier run is
+        # still writing to this one, because the view is being refreshed,
+        # then that run's output is dropped from now on:
+        #
+        self.detached = False
+        if target != 'point':
+            detach_target(self.console)
+            active_targets[self.console.id()] = self
+
+        # If the output is to be scanned for error locations then start a
+        # fresh index for the view, replacing any from a previous run:
+        #
+        self.errors = None
+        Diagnostics.indexes.pop(self.console.id(), None)
+        if file_regex or line_regex:
+            self.errors = Diagnostics.ErrorIndex(file_regex, line_regex)
+            Diagnostics.indexes[self.console.id()] = self.errors
+        self.console.settings().set(data_key + '_errors', self.errors is not None)
+
+    def append_text(self, output, scroll_show_maximum_output=False, stream=None):
+
+        if self.detached:
+            return
 
         console = self.console
 
@@ -295,20 +473,26 @@ class OutputTarget():
                 self.set_timer_status = TimeoutStateEnum.Started
                 sublime.set_timeout_async(_T, 100)
             else:
-                # Insert the output into the buffer:
+                # Gather up all of the output that has arrived since the last
+                # time round, and render it in one go, or in one go per
+                # stream if stdout and stderr are interleaved:
                 #
-                buf = ''
+                bufs = []
                 while self.set_timer_status == TimeoutStateEnum.Started:
                     try:
-                        [pos, output] = self.queue.get_nowait()
+                        [pos, output, stream] = self.queue.get_nowait()
                         self.queue.task_done()
-                        buf += output
+                        if bufs and bufs[-1][0] == stream:
+                            bufs[-1][1] += output
+                        else:
+                            bufs.append([stream, output])
                     except queue.Empty:
                         self.set_timer_status = TimeoutStateEnum.Stopped
-                        pos = -1
-                        output = buf
-
-                        console.run_command('sublime_helper_insert_text', {'pos': pos, 'msg': output})
+                        if not self.detached:
+                            for stream, buf in bufs:
+                                self.render(buf, stream)
+                            if self.stream_counts is not None:
+                                self.show_stream_counts()
 
                         # If the flag is set to show maximum output then we make the end of the buffer visible:
                         #
@@ -320,11 +504,19 @@ class OutputTarget():
                         if is_read_only:
                             console.set_read_only(True)
 
+                        self.run_idle_callbacks()
 
+        if self.profile is not None:
+            _T = self.profile.wrap('render', _T)
 
         # If we're adding to the end, and the previous item did as well, then merge:
         #
-        self.queue.put_nowait([pos, output])
+        self.queue.put_nowait([pos, output, stream])
+
+        if self.stream_counts is not None:
+            counts = self.stream_counts[stream or 'stdout']
+            counts[0] += len(output.encode('utf-8'))
+            counts[1] += output.count('\n')
 
         if self.set_timer_status == TimeoutStateEnum.Started:
             self.set_timer_status = TimeoutStateEnum.Abort
@@ -333,6 +525,112 @@ class OutputTarget():
             self.set_timer_status = TimeoutStateEnum.Started
             sublime.set_timeout_async(_T, 100)
 
+    def detach(self):
+        '''Stop writing to the view, since another run has taken it over.'''
+
+        self.detached = True
+
+    def finish(self):
+        '''Let another run have the view, now that this one has finished.'''
+
+        if active_targets.get(self.console.id()) is self:
+            del active_targets[self.console.id()]
+
+    def when_idle(self, callback):
+        '''Call callback once all queued output has been written.'''
+
+        self.idle_callbacks.append(callback)
+        if self.set_timer_status == TimeoutStateEnum.Stopped:
+            self.run_idle_callbacks()
+
+    def run_idle_callbacks(self):
+
+        callbacks, self.idle_callbacks = self.idle_callbacks, []
+        for callback in callbacks:
+            sublime.set_timeout_async(callback, 0)
+
+    def render(self, output, stream=None):
+        '''Insert a frame's worth of output at the end of the buffer.'''
+
+        console = self.console
+
+        # Only the final state of a line that is redrawn during the frame
+        # needs to be written, and if the frame starts by redrawing the
+        # line that is already there then that line is overwritten:
+        #
+        replace_line, output = Terminal.collapse_carriage_returns(output)
+        if replace_line and self.line_start is not None:
+            self.erase_line()
+
+        spans = []
+        if self.ansi is not None:
+            output, spans = self.ansi.feed(output)
+
+        if stream == 'stderr' and self.stderr_scope and output:
+            spans.append((0, len(output), self.stderr_scope))
+
+        begin = console.size()
+        console.run_command('sublime_helper_insert_text', {'pos': -1, 'msg': output})
+
+        newline = output.rfind('\n')
+        if newline != -1 or self.line_start is None:
+            self.line_start = begin + newline + 1
+
+        if spans:
+            self.add_ansi_regions(begin, spans)
+
+        if self.errors is not None:
+            self.errors.feed(output, begin)
+
+    def erase_line(self):
+        '''Remove the line that is being written, so that it can be redrawn.'''
+
+        console = self.console
+        line_start = self.line_start
+
+        console.run_command('sublime_helper_erase_text', {'a': line_start, 'b': console.size()})
+
+        # Forget any colours and errors on the line, so that they aren't
+        # applied again to whatever replaces it:
+        #
+        for scope, (key, current) in self.ansi_regions.items():
+            if current and current[-1].end() > line_start:
+                while current and current[-1].end() > line_start:
+                    region = current.pop()
+                    if region.begin() < line_start:
+                        current.append(sublime.Region(region.begin(), line_start))
+                        break
+                console.add_regions(key, current, scope, '', sublime.DRAW_NO_OUTLINE)
+
+        if self.errors is not None:
+            self.errors.discard_partial()
+
+    def add_ansi_regions(self, begin, spans):
+        '''Colour the spans for a frame with one add_regions() call per colour.'''
+
+        console = self.console
+
+        new_regions = {}
+        for a, b, scope in spans:
+            new_regions.setdefault(scope, []).append(sublime.Region(begin + a, begin + b))
+
+        for scope, regions in new_regions.items():
+            key, current = self.ansi_regions.get(scope, (None, []))
+            if key is None or len(current) >= MAX_REGIONS_PER_KEY:
+                key = '{}_ansi_{}'.format(self.data_key, self.ansi_keys)
+                self.ansi_keys += 1
+                console.settings().set(self.data_key + '_ansi_keys', self.ansi_keys)
+                current = []
+            current.extend(regions)
+            self.ansi_regions[scope] = (key, current)
+            console.add_regions(key, current, scope, '', sublime.DRAW_NO_OUTLINE)
+
+    def show_stream_counts(self):
+
+        self.console.set_status(self.data_key + '_streams', '  '.join(
+            '{}: {} lines, {} bytes'.format(name, lines, size) for name, (size, lines) in self.stream_counts.items()
+        ))
+
     def set_status(self, tag, message):
 
         self.console.set_status(tag, message)
@@ -0,0 +1,231 @@
+# Helpers for making sense of the control sequences that terminal-oriented
+# programs write to their output:
+#
+import re
+
+
+# A complete escape sequence; either a CSI sequence (such as the SGR codes
+# used to set colours), an OSC sequence (such as a window title or a
+# hyperlink), or any other two-character escape:
+#
+_ESCAPE = re.compile(r'\x1b(?:\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(?:\x07|\x1b\\)|[@-Z\\-_])')
+
+# The beginning of an escape sequence that has been split across two reads:
+#
+_PARTIAL_ESCAPE = re.compile(r'\x1b(?:\[[0-?]*[ -/]*|\][^\x07\x1b]*\x1b?)?\Z')
+
+# Carriage returns just before a newline. A terminal's output processing
+# turns each newline into a carriage return and a newline, so CR-LF from a
+# program running in a pseudo-terminal arrives as CR-CR-LF:
+#
+_CR_BEFORE_NEWLINE = re.compile(r'\r+\n')
+
+# Don't hold back more than this much text waiting for an unterminated
+# sequence to complete:
+#
+_MAX_PENDING = 256
+
+# The eight basic ANSI colours, mapped to the scopes that colour schemes
+# provide for regions. Black and white are left as the default text colour
+# since they are usually the foreground or background anyway:
+#
+_COLOR_SCOPES = [
+    None,
+    'region.redish',
+    'region.greenish',
+    'region.yellowish',
+    'region.bluish',
+    'region.purplish',
+    'region.cyanish',
+    None
+]
+
+
+class AnsiParser():
+    """
+    Strips ANSI escape sequences from a stream of text, recording the spans
+    of text that should be coloured as it goes
+
+    The parser keeps its state between calls to feed(), so a colour that is
+    set in one chunk of output carries on into the next, and a sequence that
+    is split across two chunks is still recognised.
+    """
+
+    def __init__(self):
+        self.fg = None
+        self.bg = None
+        self.scope = None
+        self._pending = ''
+
+    def feed(self, text):
+        '''Return the plain text and a list of (begin, end, scope) spans.'''
+
+        text = self._pending + text
+        self._pending = ''
+
+        # Most output has no escape sequences in it at all:
+        #
+        if '\x1b' not in text:
+            return text, self._span(0, len(text))
+
+        # If the text ends part way through a sequence then keep hold of
+        # the tail until the rest of it arrives:
+        #
+        idx = text.rfind('\x1b')
+        if len(text) - idx < _MAX_PENDING and _PARTIAL_ESCAPE.match(text, idx):
+            text, self._pending = text[:idx], text[idx:]
+
+        plain = []
+        spans = []
+        offset = 0
+        pos = 0
+
+        for match in _ESCAPE.finditer(text):
+            offset = self._emit(text[pos:match.start()], offset, plain, spans)
+            sequence = match.group(0)
+            if sequence.startswith('\x1b[') and sequence.endswith('m'):
+                self._select_graphic_rendition(sequence[2:-1])
+            pos = match.end()
+
+        self._emit(text[pos:], offset, plain, spans)
+
+        return ''.join(plain), spans
+
+    def _span(self, begin, end):
+
+        if self.scope is None or begin == end:
+            return []
+        return [(begin, end, self.scope)]
+
+    def _emit(self, text, offset, plain, spans):
+
+        if text:
+            plain.append(text)
+            end = offset + len(text)
+
+            # Extend the previous span if it's the same colour and adjacent,
+            # so that a sequence that has no visible effect doesn't split a
+            # region in two:
+            #
+            for span in self._span(offset, end):
+                if spans and spans[-1][1] == offset and spans[-1][2] == span[2]:
+                    spans[-1] = (spans[-1][0], end, span[2])
+                else:
+                    spans.append(span)
+            offset = end
+
+        return offset
+
+    def _select_graphic_rendition(self, params):
+
+        codes = params.replace(':', ';').split(';') if params else ['0']
+
+        idx = 0
+        while idx < len(codes):
+            code = int(codes[idx]) if codes[idx].isdigit() else 0
+
+            if code == 0:
+                self.fg = self.bg = None
+            elif 30 <= code <= 37:
+                self.fg = code - 30
+            elif 90 <= code <= 97:
+                self.fg = code - 90
+            elif code == 39:
+                self.fg = None
+            elif 40 <= code <= 47:
+                self.bg = code - 40
+            elif 100 <= code <= 107:
+                self.bg = code - 100
+            elif code == 49:
+                self.bg = None
+
+            # Extended colours are either '5;n' for the 256 colour palette,
+            # or '2;r;g;b' for true colour. Only the first sixteen palette
+            # entries map onto something we can show:
+            #
+            elif code in (38, 48):
+                color = None
+                mode = codes[idx + 1] if idx + 1 < len(codes) else ''
+                if mode == '5':
+                    n = codes[idx + 2] if idx + 2 < len(codes) else ''
+                    if n.isdigit() and int(n) < 16:
+                        color = int(n) % 8
+                    idx += 2
+                elif mode == '2':
+                    idx += 4
+                if code == 38:
+                    self.fg = color
+                else:
+                    self.bg = color
+
+            idx += 1
+
+        color = self.fg if self.fg is not None else self.bg
+        self.scope = _COLOR_SCOPES[color] if color is not None else None
+
+
+def collapse_carriage_returns(text):
+    '''Keep only what is left of each line once carriage returns are applied.
+
+    A carriage return moves back to the start of the line, and progress bars
+    use it to redraw the line in place, so only the text after the last one
+    in each line survives. Carriage returns just before a newline don't
+    change anything, since nothing is written after them. Any escape
+    sequences in the text that is dropped are kept, so that colours set
+    while redrawing still apply. Returns a flag to say whether the first
+    line replaces the line that was already being written, along with the
+    text.
+    '''
+
+    if '\r' not in text:
+        return False, text
+
+    text = _CR_BEFORE_NEWLINE.sub('\n', text)
+    if '\r' not in text:
+        return False, text
+
+    lines = text.split('\n')
+    replace_line = '\r' in lines[0]
+
+    for idx, line in enumerate(lines):
+        cr = line.rfind('\r')
+        if cr != -1:
+            dropped = line[:cr]
+            escapes = ''.join(_ESCAPE.findall(dropped)) if '\x1b' in dropped else ''
+            lines[idx] = escapes + line[cr + 1:]
+
+    return replace_line, '\n'.join(lines)
+
+
+class CarriageReturnFilter():
+    """
+    Collapses progress bar redraws in a stream of output as it is read
+
+    The output of feed() only ever has a carriage return at the very start,
+    which means that the text up to the first newline replaces the line that
+    is currently being written. So however many times a progress bar redraws
+    itself in one read, only its final state is passed on.
+    """
+
+    def __init__(self):
+        self.pending = False
+
+    def feed(self, text, final=False):
+
+        if self.pending:
+            text = '\r' + text
+            self.pending = False
+
+        # Carriage returns at the end might be the start of a CR-LF, so
+        # wait and see what comes next. If there is nothing next then they
+        # don't change anything:
+        #
+        if text.endswith('\r'):
+            text = text.rstrip('\r')
+            self.pending = not final
+
+        text = _CR_BEFORE_NEWLINE.sub('\n', text)
+
+        replace_line, text = collapse_carriage_returns(text)
+
+        return '\r' + text if replace_line else text
@@ -1,6 +1,15 @@
-def file_name_split(file):
-    import os
+import os
+import re
+
+import sublime
+
+
+# A variable to substitute, such as ${file_name}:
+#
+_VARIABLE = re.compile(r'\${(.*?)}')
 
+
+def file_name_split(file):
     if file is None:
         file = ''
 
@@ -23,9 +32,6 @@ def file_name_split(file):
     return file, path, name, ext, base_name
 
 def create_variable_values(view):
-    import os
-    import sublime
-
     window = view.window()
     vars = {}
 
@@ -48,8 +54,6 @@ def parse_command(commands, view):
     But it's slightly different, ${<variable_name>[:[default value][:<Prompt message if not exist>]]}
     EX) git branch -m ${current_branch} ${new_branch::Enter branch name}
     '''
-    import re
-
     vars = create_variable_values(view)
 
     asks = []
@@ -59,7 +63,7 @@ def parse_command(commands, view):
         commands = [commands]
 
     for command in commands:
-        parsed = re.split(r'\${(.*?)}', command)
+        parsed = _VARIABLE.split(command)
         # if not variables, return command itself
         if len(parsed) == 1:
             templates.append(command)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+#
+# Startup benchmark: how long the plugin takes to load, and how long the
+# first command then takes to show its output. Each run happens in a fresh
+# interpreter, so that nothing is already imported or cached, and the median
+# of the runs is compared against the budgets.
+#
+# Usage:
+#
+#   python3 tools/bench_startup.py [--runs 5] [--load-budget 20] [--first-command-budget 500]
+#
+# Budgets are in milliseconds. Exits with a non-zero status if either median
+# is over budget.
+#
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+def child():
+    '''Load the plugin, run one command, and report the timings as JSON.'''
+
+    import harness
+
+    sublime = harness.sublime
+    before = set(sys.modules)
+
+    started = time.perf_counter()
+    package = harness.load_package()
+    loaded = time.perf_counter()
+
+    window = sublime.active_window()
+    origin = window.new_file()
+    package.ShellCommand.ShellCommandCommand(origin).run_shell_command('echo ready')
+
+    # Wait for the output to reach a view:
+    #
+    first_output = None
+    deadline = time.perf_counter() + 30
+    while time.perf_counter() < deadline:
+        if any('ready' in view.substr(sublime.Region(0, view.size())) for view in window.views):
+            first_output = time.perf_counter()
+            break
+        time.sleep(0.001)
+
+    modules = sorted(name for name in set(sys.modules) - before if not name.startswith('ShellCommand'))
+
+    print(json.dumps({
+        'load': (loaded - started) * 1000,
+        'first_command': (first_output - loaded) * 1000 if first_output is not None else None,
+        'modules': modules
+    }))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--load-budget', type=float, default=20, help='milliseconds to load every module in the package')
+    parser.add_argument('--first-command-budget', type=float, default=500, help='milliseconds from loading to the first output')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child()
+        return 0
+
+    results = []
+    for n in range(args.runs):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        results.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+
+    if any(result['first_command'] is None for result in results):
+        print('the first command never produced any output')
+        return 1
+
+    load = statistics.median(result['load'] for result in results)
+    first_command = statistics.median(result['first_command'] for result in results)
+
+    print('modules imported while loading: {}'.format(' '.join(results[0]['modules'])))
+    print('load: {:.1f}ms (budget {:.0f}ms)'.format(load, args.load_budget))
+    print('first command: {:.1f}ms (budget {:.0f}ms)'.format(first_command, args.first_command_budget))
+
+    failures = []
+    if load > args.load_budget:
+        failures.append('loading took {:.1f}ms'.format(load))
+    if first_command > args.first_command_budget:
+        failures.append('the first command took {:.1f}ms'.format(first_command))
+
+    for failure in failures:
+        print('OVER BUDGET: ' + failure)
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
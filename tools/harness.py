@@ -0,0 +1,89 @@
+# Load the plugin outside of Sublime Text, against the stand-in sublime
+# module in stubs/, and measure the resources that the process is using.
+#
+import importlib
+import os
+import re
+import sys
+import threading
+import types
+
+
+TOOLS_PATH = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_PATH = os.path.dirname(TOOLS_PATH)
+
+sys.path.insert(0, os.path.join(TOOLS_PATH, 'stubs'))
+
+import sublime
+import sublime_plugin
+
+
+def command_name(class_name):
+    '''Get the name that Sublime gives to a command class.'''
+
+    name = re.sub(r'Command$', '', class_name)
+    return re.sub(r'([A-Z])', r'_\1', name).lower().lstrip('_')
+
+
+def register(module):
+    '''Make the commands and listeners in a module known to the stand-in.'''
+
+    for value in list(vars(module).values()):
+        if not isinstance(value, type):
+            continue
+        if issubclass(value, sublime_plugin.TextCommand) and value.__name__.endswith('Command'):
+            sublime.text_commands[command_name(value.__name__)] = value
+        elif issubclass(value, sublime_plugin.EventListener) and value is not sublime_plugin.EventListener:
+            sublime.event_listeners.append(value())
+
+
+def load_package(name='ShellCommand', modules=None):
+    '''Import the plugin as a package, the way that Sublime does.
+
+    If modules is None then every top-level module is loaded, as it would
+    be at startup, otherwise just the named modules are.
+    '''
+
+    package = sys.modules.get(name)
+    if package is None:
+        package = types.ModuleType(name)
+        package.__path__ = [PACKAGE_PATH]
+        sys.modules[name] = package
+
+    if modules is None:
+        modules = sorted(file_name[:-3] for file_name in os.listdir(PACKAGE_PATH) if file_name.endswith('.py'))
+
+    for module_name in modules:
+        register(importlib.import_module(name + '.' + module_name))
+
+    return package
+
+
+def thread_count():
+    return threading.active_count()
+
+
+def open_fds():
+    for fd_dir in ('/proc/self/fd', '/dev/fd'):
+        if os.path.isdir(fd_dir):
+            return len(os.listdir(fd_dir))
+    return None
+
+
+def rss_bytes():
+    '''The resident set size, where it can be found.'''
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, IOError, ValueError):
+        return None
+
+
+def measure():
+    return {
+        'threads': thread_count(),
+        'fds': open_fds(),
+        'rss': rss_bytes(),
+        'timers': sublime.pending_timers()
+    }
@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+#
+# Regression checks: drive the plugin through cases that have gone wrong
+# before, and check that the output is what a user would expect to see.
+#
+# Usage:
+#
+#   python3 tools/regressions.py [name ...]
+#
+# Runs every check, or just the named ones, and exits with a non-zero status
+# if any of them fail.
+#
+import os
+import sys
+import tempfile
+import time
+import traceback
+
+import harness
+
+
+SLOW_COMMAND = 'for i in 1 2 3 4 5; do echo line $i; sleep 0.1; done'
+SLOW_OUTPUT = ''.join('line {}\n'.format(i) for i in range(1, 6))
+
+
+def text(view):
+    return view.substr(harness.sublime.Region(0, view.size()))
+
+
+def wait_for(condition, timeout=10):
+    '''Wait until condition() is true, and all output has been drawn.'''
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition() and harness.sublime.pending_timers() == 0:
+            return True
+        time.sleep(0.02)
+
+    return False
+
+
+def idle(package):
+
+    scheduler = package.OsShell.scheduler
+    with scheduler.lock:
+        return not (scheduler.total or scheduler.pending or scheduler.jobs)
+
+
+def new_window():
+
+    sublime = harness.sublime
+    window = sublime.Window()
+    sublime._windows.insert(0, window)
+    return window
+
+
+def check_run_twice_from_one_view(package):
+    '''Running a command again before it finishes shows its output once.'''
+
+    window = new_window()
+    command = package.ShellCommand.ShellCommandCommand(window.new_file())
+
+    command.run_shell_command(SLOW_COMMAND)
+    time.sleep(0.25)
+    command.run_shell_command(SLOW_COMMAND)
+    assert wait_for(lambda: idle(package))
+
+    outputs = [text(view) for view in window.views[1:]]
+    assert outputs and all(output == SLOW_OUTPUT for output in outputs), outputs
+
+
+def check_refresh_while_running(package):
+    '''Refreshing a view while its command is still running shows the output once.'''
+
+    window = new_window()
+    package.ShellCommand.ShellCommandCommand(window.new_file()).run_shell_command(SLOW_COMMAND)
+    assert wait_for(lambda: len(window.views) == 2, 5)
+
+    output_view = window.views[1]
+    time.sleep(0.2)
+    output_view.run_command('shell_command_refresh')
+    assert wait_for(lambda: idle(package))
+
+    assert text(output_view) == SLOW_OUTPUT, text(output_view)
+
+
+def check_large_output_is_not_kept(package):
+    '''A running command lets go of its output once there's too much to share.'''
+
+    OsShell = package.OsShell
+    chunks = []
+
+    OsShell.process('seq 1 300000; sleep 1', callback=lambda output: chunks.append(output))
+    assert wait_for(lambda: sum(len(chunk) for chunk in chunks if chunk) > OsShell.MAX_SHARED_OUTPUT, 5)
+    time.sleep(0.2)
+
+    with OsShell.scheduler.lock:
+        jobs = list(OsShell.scheduler.jobs.values())
+    assert not jobs, [job.history_size for job in jobs]
+    assert wait_for(lambda: idle(package))
+
+
+def check_crlf_output(package):
+    '''CR-LF line endings are kept as lines, with or without a pseudo-terminal.'''
+
+    command = r"printf 'HTTP/1.1 200 OK\r\nH: 2\r\n\r\nbody\n'"
+    expected = 'HTTP/1.1 200 OK\nH: 2\n\nbody\n'
+
+    for pty in (False, True):
+        output = package.OsShell.process(command, pty=pty)
+        assert output == expected, (pty, output)
+
+
+def check_busy_view_is_not_reused(package):
+    '''A view that is still being written to isn't cleared for another run.'''
+
+    window = new_window()
+    origin = window.new_file()
+    command = 'echo x1; sleep 0.3; echo x2; cat; echo x3'
+
+    package.ShellCommand.ShellCommandCommand(origin).run_shell_command(command, stdin='A')
+    time.sleep(0.2)
+    package.ShellCommand.ShellCommandCommand(origin).run_shell_command(command, stdin='B')
+    assert wait_for(lambda: idle(package))
+
+    outputs = sorted(text(view) for view in window.views[1:])
+    assert outputs == ['x1\nx2\nAx3\n', 'x1\nx2\nBx3\n'], outputs
+
+
+def check_reused_view_loses_old_colours(package):
+    '''Colours from the last run are removed when an output view is reused.'''
+
+    window = new_window()
+    command = package.ShellCommand.ShellCommandCommand(window.new_file())
+
+    command.run_shell_command(r'printf "\033[31mred\033[0m\n"', title='Colours')
+    assert wait_for(lambda: idle(package) and len(window.views) == 2)
+    output_view = window.views[1]
+    assert output_view.get_regions('ShellCommand_ansi_0')
+
+    command.run_shell_command('echo plain', title='Colours')
+    assert wait_for(lambda: idle(package) and text(output_view) == 'plain\n')
+    assert not output_view.get_regions('ShellCommand_ansi_0')
+
+
+def check_output_view_pool(package):
+    '''Closing spare output views leaves busy ones alone, and counts a refresh as a use.'''
+
+    settings = harness.sublime.load_settings('ShellCommand.sublime-settings')
+    pool_size = settings.get('output_view_pool_size')
+    window = new_window()
+    command = package.ShellCommand.ShellCommandCommand(window.new_file())
+
+    def _view(title):
+        views = [view for view in window.views if view.name == title]
+        return views[0] if views else None
+
+    try:
+
+        # A view that is still being written to stays open:
+        #
+        settings.set('output_view_pool_size', 1)
+        command.run_shell_command(SLOW_COMMAND, title='Slow')
+        time.sleep(0.2)
+        slow = _view('Slow')
+        assert slow is not None
+        command.run_shell_command('echo fast', title='Fast')
+        assert wait_for(lambda: idle(package))
+        assert slow.is_valid() and text(slow) == SLOW_OUTPUT, text(slow)
+
+        # A view that has been refreshed is closed after one that hasn't:
+        #
+        settings.set('output_view_pool_size', 2)
+        for title in ('A', 'B'):
+            command.run_shell_command('echo ' + title, title=title)
+            assert wait_for(lambda: idle(package) and _view(title) is not None)
+        first = _view('A')
+        first.run_command('shell_command_refresh')
+        assert wait_for(lambda: idle(package))
+        command.run_shell_command('echo C', title='C')
+        assert wait_for(lambda: idle(package) and _view('C') is not None)
+        assert first.is_valid() and _view('B') is None, [view.name for view in window.views]
+    finally:
+        settings.set('output_view_pool_size', pool_size)
+
+
+def check_shell_environment(package):
+    '''Only the configuration file's changes are cached, on top of the current environment.'''
+
+    OsShell = package.OsShell
+
+    with tempfile.NamedTemporaryFile('w', suffix='.sh', delete=False) as f:
+        f.write('export FROM_RC=1\nunset REMOVED_BY_RC\n')
+    try:
+        os.environ['REMOVED_BY_RC'] = 'x'
+        os.environ['SESSION_VALUE'] = 'first'
+        env = OsShell.get_shell_environment(f.name, '/bin/sh')
+        assert env['FROM_RC'] == '1' and 'REMOVED_BY_RC' not in env and env['SESSION_VALUE'] == 'first'
+
+        cached = OsShell._environments['/bin/sh|{}|'.format(f.name)]
+        assert 'SESSION_VALUE' not in cached['changes'], cached['changes']
+
+        # A change to the editor's environment shows through:
+        #
+        os.environ['SESSION_VALUE'] = 'second'
+        env = OsShell.get_shell_environment(f.name, '/bin/sh')
+        assert env['SESSION_VALUE'] == 'second' and env['FROM_RC'] == '1'
+    finally:
+        os.unlink(f.name)
+        del os.environ['REMOVED_BY_RC'], os.environ['SESSION_VALUE']
+
+    # A shell that can't be captured is only tried once:
+    #
+    assert OsShell.get_shell_environment(None, '/bin/false', login=True) is None
+    started = time.time()
+    assert OsShell.get_shell_environment(None, '/bin/false', login=True) is None
+    assert OsShell._environments['/bin/false||login']['changes'] is None
+    assert time.time() - started < 0.05
+
+
+def check_next_error_from_the_end(package):
+    '''The first move to an error starts from the top, even when it's on the first line.'''
+
+    window = new_window()
+    command = package.ShellCommand.ShellCommandCommand(window.new_file())
+    command.run_shell_command(r'printf "a.c:1:2: bad\nok\nb.c:3:4: worse\n"', file_regex=r'^(\S+):(\d+):(\d+):')
+    assert wait_for(lambda: idle(package) and len(window.views) == 2)
+
+    # The cursor follows the output to the end of the view:
+    #
+    output_view = window.views[1]
+    output_view.sel().clear()
+    output_view.sel().add(harness.sublime.Region(output_view.size()))
+
+    for expected in ('a.c:1:2', 'b.c:3:4'):
+        output_view.run_command('shell_command_next_error')
+        assert window.opened and window.opened[-1].endswith(expected), window.opened
+
+    output_view.run_command('shell_command_previous_error')
+    assert window.opened[-1].endswith('a.c:1:2'), window.opened
+
+
+def check_overlapping_profiles(package):
+    '''Each of two overlapping profiles reports allocations, and tracing stops after both.'''
+
+    import tracemalloc
+    from ShellCommand import Profiler
+
+    first = Profiler.Session('first')
+    second = Profiler.Session('second')
+    assert '== allocations ==' in first.report()
+    assert '== allocations ==' in second.report()
+    assert not tracemalloc.is_tracing()
+
+
+def check_profile_without_tracemalloc(package):
+    '''Profiling still works on a Python that has no tracemalloc.'''
+
+    from ShellCommand import Profiler
+
+    saved = sys.modules.get('tracemalloc')
+    sys.modules['tracemalloc'] = None
+    try:
+        session = Profiler.Session('no tracemalloc')
+        session.wrap('work', sum)(range(10))
+        report = session.report()
+    finally:
+        sys.modules['tracemalloc'] = saved
+
+    assert '== work ==' in report and '== allocations ==' not in report, report
+
+
+def check_profile_finished_before_report(package):
+    '''A profiled command's profile is switched off before it's said to have finished.'''
+
+    from ShellCommand import Profiler
+
+    session = Profiler.Session('finish')
+    wrap = session.wrap
+    returned = []
+    finished = []
+
+    def _wrap(label, fn):
+        profiled = wrap(label, fn)
+
+        def _wrapper(*args, **kwargs):
+            # Give an early completion time to arrive before noting that the
+            # profile has been switched off:
+            #
+            try:
+                return profiled(*args, **kwargs)
+            finally:
+                time.sleep(0.1)
+                returned.append(label)
+
+        return _wrapper
+
+    def _callback(output):
+        if output is None:
+            finished.append(list(returned))
+
+    session.wrap = _wrap
+    package.OsShell.process('echo profiled', callback=_callback, profile=session)
+    assert wait_for(lambda: finished)
+    assert finished == [['process']], finished
+    session.report()
+
+
+def check_overlapping_each_runs(package):
+    '''Two runs over different regions of a view each replace their own regions.'''
+
+    sublime = harness.sublime
+    window = new_window()
+    view = window.new_file()
+    view.insert(None, 0, 'abc xyz')
+
+    ShellCommandCommand = package.ShellCommand.ShellCommandCommand
+    ShellCommandCommand(view).run_shell_command_each('sleep 0.3; tr a-z A-Z', [sublime.Region(0, 3)])
+    ShellCommandCommand(view).run_shell_command_each('rev', [sublime.Region(4, 7)])
+    assert wait_for(lambda: idle(package) and text(view) != 'abc xyz')
+    time.sleep(0.5)
+    assert wait_for(lambda: idle(package))
+
+    assert text(view) == 'ABC zyx', text(view)
+    assert not [key for key in view._regions if '_each' in key], view._regions
+
+
+def check_failed_each_run_cleans_up(package):
+    '''A run over regions that fails still stops its progress bar and lets go of its regions.'''
+
+    window = new_window()
+    view = window.new_file()
+    view.insert(None, 0, 'abc')
+
+    def _fail(*args, **kwargs):
+        raise RuntimeError('expected failure')
+
+    command = package.ShellCommand.ShellCommandCommand(view)
+    command.run_shell_command_raw = _fail
+
+    try:
+        command.run_shell_command_each('cat', [harness.sublime.Region(0, 3)])
+    except RuntimeError:
+        pass
+    assert wait_for(lambda: not view._regions, 5), view._regions
+    assert text(view) == 'abc'
+
+
+def check_failing_each_run_keeps_text(package):
+    '''A region whose command fails keeps its text, while the others are replaced.'''
+
+    sublime = harness.sublime
+    window = new_window()
+    view = window.new_file()
+    view.insert(None, 0, 'abc bad xyz')
+
+    command = 'read word; [ "$word" != bad ] || { echo "no good" >&2; exit 1; }; echo $word | tr a-z A-Z'
+    regions = [sublime.Region(0, 3), sublime.Region(4, 7), sublime.Region(8, 11)]
+    package.ShellCommand.ShellCommandCommand(view).run_shell_command_each(command, regions)
+    assert wait_for(lambda: idle(package) and not view._regions)
+
+    assert text(view) == 'ABC bad XYZ', text(view)
+
+
+def check_each_run_does_not_hold_up_others(package):
+    '''A slow run over regions doesn't stop other commands from showing their output.'''
+
+    sublime = harness.sublime
+    window = new_window()
+    view = window.new_file()
+    view.insert(None, 0, 'abc')
+
+    ShellCommandCommand = package.ShellCommand.ShellCommandCommand
+    ShellCommandCommand(view).run_shell_command_each('sleep 2; cat', [sublime.Region(0, 3)])
+    time.sleep(0.1)
+
+    chunks = []
+    started = time.time()
+    package.OsShell.process('echo hi', callback=lambda output: chunks.append((output, time.time() - started)))
+    assert wait_for(lambda: chunks and chunks[-1][0] is None, 5)
+    assert chunks[0][0] == 'hi\n' and chunks[0][1] < 1, chunks
+
+    assert wait_for(lambda: idle(package) and not view._regions)
+    assert text(view) == 'abc'
+
+
+CHECKS = [
+    check_run_twice_from_one_view,
+    check_refresh_while_running,
+    check_large_output_is_not_kept,
+    check_crlf_output,
+    check_busy_view_is_not_reused,
+    check_reused_view_loses_old_colours,
+    check_output_view_pool,
+    check_shell_environment,
+    check_next_error_from_the_end,
+    check_overlapping_profiles,
+    check_profile_without_tracemalloc,
+    check_profile_finished_before_report,
+    check_overlapping_each_runs,
+    check_failed_each_run_cleans_up,
+    check_failing_each_run_keeps_text,
+    check_each_run_does_not_hold_up_others,
+]
+
+
+def main():
+
+    package = harness.load_package()
+
+    names = sys.argv[1:]
+    failures = 0
+    for check in CHECKS:
+        name = check.__name__[len('check_'):]
+        if names and name not in names:
+            continue
+
+        try:
+            check(package)
+            print('ok: ' + name)
+        except Exception:
+            failures += 1
+            print('FAILED: ' + name)
+            traceback.print_exc()
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+#
+# Soak test: run thousands of commands through the plugin at once, including
+# ones that fail, ones with lots of output and ones with stderr kept
+# separate, and check that threads, file descriptors, memory and timers all
+# go back to where they started.
+#
+# Usage:
+#
+#   python3 tools/soak.py [--commands 1000] [--rounds 3]
+#
+# Exits with a non-zero status if anything has leaked.
+#
+import argparse
+import gc
+import sys
+import time
+
+import harness
+
+
+# A mix of short, high-volume, coloured and failing commands. Some are
+# unique, so that each gets its own process, and some are repeated so that
+# the scheduler shares their output:
+#
+COMMANDS = [
+    'echo short {n}',
+    'seq 1 20000 # {n}',
+    'printf "\\033[31mred\\033[0m {n}\\n%.0s" $(seq 1 200)',
+    'exit 3 # {n}',
+    'no_such_command_for_soak_test_{n}',
+    'echo to stderr {n} >&2; exit 1',
+    'yes {n} | head -n 5000',
+    'sleep 0.05; echo done {n}',
+    'seq 1 100',
+]
+
+INPUT = 'x' * 100000
+
+
+def wait_until_idle(OsShell, timeout):
+
+    sublime = harness.sublime
+    scheduler = OsShell.scheduler
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with scheduler.lock:
+            busy = scheduler.total or scheduler.pending or scheduler.jobs
+        if not busy and sublime.pending_timers() == 0:
+            return True
+        time.sleep(0.05)
+
+    return False
+
+
+def run_round(package, window, count, timeout):
+
+    ShellCommand = package.ShellCommand
+
+    origin = window.new_file()
+    for n in range(count):
+        command = COMMANDS[n % len(COMMANDS)].format(n=n)
+        stdin = INPUT if n % 11 == 0 else None
+        if stdin is not None:
+            command = 'wc -c # {}'.format(n)
+        stderr = 'separate' if n % 3 == 0 else None
+        ShellCommand.ShellCommandCommand(origin).run_shell_command(command, stdin=stdin, stderr=stderr)
+
+    idle = wait_until_idle(package.OsShell, timeout)
+
+    # Close everything the round opened, as a user would:
+    #
+    for view in list(window.views):
+        view.close()
+    for panel in list(window.panels.values()):
+        panel.close()
+    window.panels.clear()
+
+    return idle
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--commands', type=int, default=1000, help='commands to run at once in each round')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for each round')
+    parser.add_argument('--max-rss-growth', type=float, default=64, help='allowed RSS growth in MB')
+    args = parser.parse_args()
+
+    package = harness.load_package()
+    window = harness.sublime.active_window()
+
+    # Warm up, so that one-off costs such as imports and caches aren't
+    # counted as leaks:
+    #
+    run_round(package, window, len(COMMANDS) * 2, args.timeout)
+    gc.collect()
+    baseline = harness.measure()
+
+    for n in range(args.rounds):
+        started = time.time()
+        if not run_round(package, window, args.commands, args.timeout):
+            print('round {}: timed out waiting for commands to finish'.format(n + 1))
+            return 1
+        print('round {}: {} commands in {:.1f}s'.format(n + 1, args.commands, time.time() - started))
+
+    gc.collect()
+    after = harness.measure()
+
+    failures = []
+    for key in ('threads', 'fds', 'timers'):
+        if after[key] is not None and after[key] > baseline[key]:
+            failures.append('{}: {} -> {}'.format(key, baseline[key], after[key]))
+
+    if after['rss'] is not None:
+        growth = (after['rss'] - baseline['rss']) / (1024.0 * 1024.0)
+        print('rss: {:.1f}MB -> {:.1f}MB'.format(baseline['rss'] / (1024.0 * 1024.0), after['rss'] / (1024.0 * 1024.0)))
+        if growth > args.max_rss_growth:
+            failures.append('rss grew by {:.1f}MB'.format(growth))
+
+    if package.Diagnostics.indexes:
+        failures.append('{} error indexes left behind'.format(len(package.Diagnostics.indexes)))
+
+    print('threads: {threads}, fds: {fds}, timers: {timers}'.format(**after))
+
+    for failure in failures:
+        print('LEAK: ' + failure)
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
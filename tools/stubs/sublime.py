@@ -0,0 +1,384 @@
+# A stand-in for the parts of the sublime module that ShellCommand uses, so
+# that the plugin can be driven without an editor.
+#
+# Timers run on a single background thread, playing the part of Sublime's
+# async thread, and views keep their text in a string. Commands run through
+# View.run_command() are looked up among the TextCommand classes that the
+# loaded plugin modules define.
+#
+import heapq
+import itertools
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+
+HIDDEN = 128
+DRAW_NO_OUTLINE = 256
+CLASS_WORD_START = 1
+CLASS_WORD_END = 2
+ENCODED_POSITION = 1
+LITERAL = 1
+TRANSIENT = 4
+
+_package_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_cache_path = tempfile.mkdtemp(prefix='shell-command-cache-')
+
+# Plugin classes that the harness has registered, by kind:
+#
+text_commands = {}
+event_listeners = []
+
+
+class Region():
+
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return self.end() - self.begin()
+
+    def empty(self):
+        return self.a == self.b
+
+    def __eq__(self, other):
+        return isinstance(other, Region) and (self.a, self.b) == (other.a, other.b)
+
+    def __repr__(self):
+        return 'Region({}, {})'.format(self.a, self.b)
+
+
+class Selection(list):
+
+    def clear(self):
+        del self[:]
+
+    def add(self, region):
+        self.append(region)
+
+
+class Settings():
+
+    def __init__(self, values=None):
+        self.values = dict(values or {})
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def has(self, key):
+        return key in self.values
+
+    def erase(self, key):
+        self.values.pop(key, None)
+
+
+class Edit():
+    pass
+
+
+class View():
+
+    _ids = itertools.count(1)
+
+    def __init__(self, window=None):
+        self._id = next(View._ids)
+        self._window = window
+        self._text = ''
+        self._settings = Settings()
+        self._regions = {}
+        self._read_only = False
+        self._valid = True
+        self._sel = Selection([Region(0)])
+        self.lock = threading.RLock()
+        self.name = ''
+        self.status = {}
+
+    def id(self):
+        return self._id
+
+    def window(self):
+        return self._window
+
+    def is_valid(self):
+        return self._valid
+
+    def close(self):
+        if self._valid:
+            self._valid = False
+            for listener in event_listeners:
+                if hasattr(listener, 'on_close'):
+                    listener.on_close(self)
+            if self._window is not None and self in self._window.views:
+                self._window.views.remove(self)
+        return True
+
+    def size(self):
+        return len(self._text)
+
+    def substr(self, region):
+        if isinstance(region, int):
+            return self._text[region:region + 1]
+        return self._text[region.begin():region.end()]
+
+    def line(self, point):
+        if isinstance(point, Region):
+            point = point.begin()
+        begin = self._text.rfind('\n', 0, point) + 1
+        end = self._text.find('\n', point)
+        return Region(begin, len(self._text) if end == -1 else end)
+
+    def text_point(self, row, col):
+        lines = self._text.split('\n')
+        return sum(len(line) + 1 for line in lines[:row]) + col
+
+    def insert(self, edit, pos, text):
+        with self.lock:
+            self._text = self._text[:pos] + text + self._text[pos:]
+        return len(text)
+
+    def erase(self, edit, region):
+        with self.lock:
+            self._text = self._text[:region.begin()] + self._text[region.end():]
+
+    def replace(self, edit, region, text):
+        with self.lock:
+            self._text = self._text[:region.begin()] + text + self._text[region.end():]
+
+    def expand_by_class(self, region, classes, separators=''):
+        return region
+
+    def settings(self):
+        return self._settings
+
+    def is_read_only(self):
+        return self._read_only
+
+    def set_read_only(self, value):
+        self._read_only = value
+
+    def set_scratch(self, value):
+        pass
+
+    def set_name(self, name):
+        self.name = name
+
+    def set_syntax_file(self, syntax_file):
+        self.syntax_file = syntax_file
+
+    def set_status(self, key, value):
+        self.status[key] = value
+
+    def erase_status(self, key):
+        self.status.pop(key, None)
+
+    def sel(self):
+        return self._sel
+
+    def show(self, point, show_surrounds=True):
+        pass
+
+    def file_name(self):
+        return None
+
+    def add_regions(self, key, regions, scope='', icon='', flags=0):
+        self._regions[key] = list(regions)
+
+    def get_regions(self, key):
+        return list(self._regions.get(key, []))
+
+    def erase_regions(self, key):
+        self._regions.pop(key, None)
+
+    def run_command(self, name, args=None):
+        command = text_commands.get(name)
+        if command is not None:
+            with self.lock:
+                command(self).run(Edit(), **(args or {}))
+
+
+class Window():
+
+    _ids = itertools.count(1)
+
+    def __init__(self):
+        self._id = next(Window._ids)
+        self.views = []
+        self.panels = {}
+        self.opened = []
+
+    def id(self):
+        return self._id
+
+    def new_file(self):
+        view = View(self)
+        self.views.append(view)
+        return view
+
+    def get_output_panel(self, name):
+        if name not in self.panels:
+            self.panels[name] = View(self)
+        return self.panels[name]
+
+    def run_command(self, name, args=None):
+        pass
+
+    def active_view(self):
+        return self.views[-1] if self.views else None
+
+    def num_groups(self):
+        return 1
+
+    def active_view_in_group(self, group):
+        return self.active_view()
+
+    def focus_view(self, view):
+        if view in self.views:
+            self.views.remove(view)
+            self.views.append(view)
+
+    def folders(self):
+        return []
+
+    def project_file_name(self):
+        return None
+
+    def show_input_panel(self, caption, initial_text, on_done, on_change, on_cancel):
+        return View(self)
+
+    def show_quick_panel(self, items, on_select, flags=0, selected_index=-1, on_highlight=None):
+        self.quick_panel = items
+
+    def open_file(self, file_name, flags=0):
+        self.opened.append(file_name)
+        return View(self)
+
+
+_windows = [Window()]
+
+
+def active_window():
+    return _windows[0]
+
+
+def windows():
+    return list(_windows)
+
+
+# Timers:
+#
+class _Timers():
+
+    def __init__(self):
+        self.heap = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.active = 0
+        self.thread = threading.Thread(target=self.run, name='sublime-async', daemon=True)
+        self.thread.start()
+
+    def add(self, callback, delay):
+        with self.condition:
+            heapq.heappush(self.heap, (time.time() + delay / 1000.0, next(self.sequence), callback))
+            self.condition.notify()
+
+    def pending(self):
+        with self.condition:
+            return len(self.heap) + self.active
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.condition.wait(self.heap[0][0] - time.time() if self.heap else None)
+                _, _, callback = heapq.heappop(self.heap)
+                self.active += 1
+            try:
+                callback()
+            except Exception:
+                import traceback
+                traceback.print_exc()
+            finally:
+                with self.condition:
+                    self.active -= 1
+
+
+_timers = _Timers()
+
+
+def set_timeout(callback, delay=0):
+    _timers.add(callback, delay)
+
+
+def set_timeout_async(callback, delay=0):
+    _timers.add(callback, delay)
+
+
+def pending_timers():
+    '''Not part of the real API: the number of timers still to run.'''
+
+    return _timers.pending()
+
+
+# Settings and resources:
+#
+_settings = {}
+
+
+def load_settings(name):
+    if name not in _settings:
+        values = {}
+        file_name = os.path.join(_package_path, name)
+        if os.path.exists(file_name):
+            with open(file_name) as f:
+                text = f.read()
+
+            # Remove comments, and the leading commas that the settings
+            # files use between entries:
+            #
+            text = re.sub(r'/\*.*?\*/', '', text, flags=re.DOTALL)
+            text = re.sub(r'^\s*//.*$', '', text, flags=re.MULTILINE)
+            text = re.sub(r'{\s*,', '{', text)
+            values = json.loads(text)
+        _settings[name] = Settings(values)
+    return _settings[name]
+
+
+def find_resources(pattern):
+    return []
+
+
+def packages_path():
+    return os.path.dirname(_package_path)
+
+
+def cache_path():
+    return _cache_path
+
+
+def message_dialog(message):
+    pass
+
+
+def status_message(message):
+    pass
+
+
+def version():
+    return '4000'
+
+
+def platform():
+    return 'linux'
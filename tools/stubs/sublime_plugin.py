@@ -0,0 +1,18 @@
+# A stand-in for the sublime_plugin module. See sublime.py.
+#
+
+
+class TextCommand():
+
+    def __init__(self, view):
+        self.view = view
+
+
+class WindowCommand():
+
+    def __init__(self, window):
+        self.window = window
+
+
+class EventListener():
+    pass